@@ -3,5 +3,24 @@ class DrawingInterface:
     def load_model(self, config, checkpoint):
         pass
 
-
-
+def migrate_optimizer_state(opts, old_param, new_param, remap):
+    # swap old_param for new_param in whichever optimizer holds it.
+    # per element state (eg: adam moments) goes through remap so it
+    # matches the new shape, everything else (eg: step) is kept as is.
+    # without a remap the state is dropped and starts over.
+    if opts is None:
+        return
+    for opt in opts:
+        for group in opt.param_groups:
+            for i, p in enumerate(group['params']):
+                if p is not old_param:
+                    continue
+                group['params'][i] = new_param
+                if old_param in opt.state:
+                    state = opt.state.pop(old_param)
+                    if remap is None:
+                        continue
+                    for k, v in state.items():
+                        if hasattr(v, 'shape') and v.shape == old_param.shape:
+                            state[k] = remap(v)
+                    opt.state[new_param] = state
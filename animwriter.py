@@ -0,0 +1,91 @@
+# In process writer for the animation preview (gif or animated webp).
+#
+# Frames are kept in memory and only the ones whose pixels changed are
+# re-palettized. Writing the file happens on a background thread and
+# requests that arrive while a write is running are coalesced into one
+# more write, so the training loop never waits on the encoder.
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+class AnimationWriter:
+    def __init__(self, output_file, num_frames, frame_duration=100):
+        self.output_file = output_file
+        self.frame_duration = frame_duration
+        self.is_webp = output_file.lower().endswith('.webp')
+        self.frame_bytes = [None] * num_frames
+        self.frames = [None] * num_frames
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        self.writing = False
+        self.dirty = False
+
+    def update(self, index, img):
+        # returns True if the frame changed
+        img = img.convert('RGB')
+        data = img.tobytes()
+        if data == self.frame_bytes[index]:
+            return False
+        self.frame_bytes[index] = data
+        if self.is_webp:
+            frame = img
+        else:
+            frame = img.quantize(colors=256)
+        with self.lock:
+            self.frames[index] = frame
+        return True
+
+    def write(self):
+        with self.lock:
+            if self.writing:
+                self.dirty = True
+                return
+            self.writing = True
+            self.future = self.executor.submit(self._write_loop)
+
+    def flush(self):
+        # wait for any pending write, returns the output file
+        future = self.future
+        if future is not None:
+            future.result()
+        return self.output_file
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
+
+    def _write_loop(self):
+        # writing is cleared under the same lock as the dirty check so a
+        # request can't slip in between. a failed save (disk full, bad
+        # path) also clears it, otherwise every later preview is dropped
+        finished = False
+        try:
+            while not finished:
+                with self.lock:
+                    self.dirty = False
+                    frames = [frame for frame in self.frames if frame is not None]
+                if len(frames) > 0:
+                    self._save(frames)
+                with self.lock:
+                    if not self.dirty:
+                        self.writing = False
+                        finished = True
+        except Exception as e:
+            print(f"Failed to write animation {self.output_file}: {e}")
+        finally:
+            if not finished:
+                with self.lock:
+                    self.writing = False
+
+    def _save(self, frames):
+        # write next to the target and swap it in so readers never
+        # see a half written file
+        file_format = 'WEBP' if self.is_webp else 'GIF'
+        tmp_file = f'{self.output_file}.tmp'
+        frames[0].save(tmp_file, format=file_format, save_all=True, append_images=frames[1:],
+                       duration=self.frame_duration, loop=0)
+        os.replace(tmp_file, self.output_file)
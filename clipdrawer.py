@@ -3,9 +3,15 @@
 # Kevin Frans, L.B. Soros, Olaf Witkowski
 # https://arxiv.org/abs/2106.14843
 
-from DrawingInterface import DrawingInterface
-
-import pydiffvg
+from DrawingInterface import DrawingInterface, migrate_optimizer_state
+import softraster
+
+try:
+    import pydiffvg
+    pydiffvg.set_print_timing(False)
+except ImportError:
+    # the soft renderer does not need diffvg
+    pydiffvg = None
 import torch
 import skimage
 import skimage.io
@@ -18,37 +24,39 @@ import torchvision.transforms as transforms
 import numpy as np
 import PIL.Image
 
-pydiffvg.set_print_timing(False)
-
 class ClipDrawer(DrawingInterface):
     num_paths = 256
     max_width = 50
 
-    def __init__(self, width, height, num_paths):
+    def __init__(self, width, height, num_paths, renderer='diffvg'):
        super(DrawingInterface, self).__init__()
 
        self.canvas_width = width
        self.canvas_height = height
        self.num_paths = num_paths
+       self.renderer = renderer
 
     def load_model(self, config_path, checkpoint_path, device):
         # gamma = 1.0
 
-        # Use GPU if available
-        pydiffvg.set_use_gpu(torch.cuda.is_available())
-        device = torch.device('cuda')
-        pydiffvg.set_device(device)
+        if self.renderer == 'soft':
+            self.device = device
+        else:
+            if pydiffvg is None:
+                raise ValueError("pydiffvg is not installed, use the soft clipdraw renderer instead")
+            # Use GPU if available
+            pydiffvg.set_use_gpu(torch.cuda.is_available())
+            self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+            pydiffvg.set_device(self.device)
 
         canvas_width, canvas_height = self.canvas_width, self.canvas_height
         num_paths = self.num_paths
         max_width = canvas_height / 10
 
         # Initialize Random Curves
-        shapes = []
-        shape_groups = []
+        path_points = []
         for i in range(num_paths):
             num_segments = random.randint(1, 3)
-            num_control_points = torch.zeros(num_segments, dtype = torch.int32) + 2
             points = []
             p0 = (random.random(), random.random())
             points.append(p0)
@@ -61,48 +69,87 @@ class ClipDrawer(DrawingInterface):
                 points.append(p2)
                 points.append(p3)
                 p0 = p3
-            points = torch.tensor(points)
-            points[:, 0] *= canvas_width
-            points[:, 1] *= canvas_height
-            path = pydiffvg.Path(num_control_points = num_control_points, points = points, stroke_width = torch.tensor(max_width/10), is_closed = False)
-            shapes.append(path)
-            path_group = pydiffvg.ShapeGroup(shape_ids = torch.tensor([len(shapes) - 1]), fill_color = None, stroke_color = torch.tensor([random.random(), random.random(), random.random(), random.random()]))
-            shape_groups.append(path_group)
-
-        # Just some diffvg setup
-        scene_args = pydiffvg.RenderFunction.serialize_scene(\
-            canvas_width, canvas_height, shapes, shape_groups)
-        render = pydiffvg.RenderFunction.apply
-        img = render(canvas_width, canvas_height, 2, 2, 0, None, *scene_args)
-
-        points_vars = []
-        stroke_width_vars = []
-        color_vars = []
-        for path in shapes:
-            path.points.requires_grad = True
-            points_vars.append(path.points)
-            path.stroke_width.requires_grad = True
-            stroke_width_vars.append(path.stroke_width)
-        for group in shape_groups:
-            group.stroke_color.requires_grad = True
-            color_vars.append(group.stroke_color)
+            path_points.append(points)
+
+        # all strokes are packed into three contiguous tensors; the
+        # diffvg paths and groups below only hold views into them
+        # the soft renderer keeps its tensors on the run device,
+        # diffvg takes cpu tensors and moves them itself
+        param_device = self.device if self.renderer == 'soft' else None
+        self.points = torch.tensor([p for points in path_points for p in points], device=param_device)
+        self.points[:, 0] *= canvas_width
+        self.points[:, 1] *= canvas_height
+        self.stroke_widths = torch.full((num_paths,), max_width/10, device=param_device)
+        self.stroke_colors = torch.rand(num_paths, 4, device=param_device)
+        self.points.requires_grad = True
+        self.stroke_widths.requires_grad = True
+        self.stroke_colors.requires_grad = True
+
+        self.build_paths([len(points) for points in path_points])
+        if self.renderer == 'soft':
+            img = None
+        else:
+            # Just some diffvg setup
+            scene_args = pydiffvg.RenderFunction.serialize_scene(\
+                canvas_width, canvas_height, self.shapes, self.shape_groups)
+            render = pydiffvg.RenderFunction.apply
+            img = render(canvas_width, canvas_height, 2, 2, 0, None, *scene_args)
 
         # Optimizers
-        points_optim = torch.optim.Adam(points_vars, lr=1.0)
-        width_optim = torch.optim.Adam(stroke_width_vars, lr=0.1)
-        color_optim = torch.optim.Adam(color_vars, lr=0.01)
+        points_optim = torch.optim.Adam([self.points], lr=1.0)
+        width_optim = torch.optim.Adam([self.stroke_widths], lr=0.1)
+        color_optim = torch.optim.Adam([self.stroke_colors], lr=0.01)
 
         self.img = img
-        self.shapes = shapes 
-        self.shape_groups  = shape_groups
         self.max_width = max_width
         self.canvas_width = canvas_width
         self.canvas_height = canvas_height
         self.opts = [points_optim, width_optim, color_optim]
 
+    def build_paths(self, path_sizes):
+        # path_sizes[i] is the number of points of path i in the packed
+        # self.points (1 + 3 per segment)
+        self.path_sizes = path_sizes
+        self.shapes = []
+        self.shape_groups = []
+        if self.renderer == 'soft':
+            self.curve_index = softraster.curve_index_table(path_sizes).to(self.points.device)
+            return
+        offset = 0
+        for i, num_points in enumerate(path_sizes):
+            num_segments = (num_points - 1) // 3
+            num_control_points = torch.zeros(num_segments, dtype = torch.int32) + 2
+            path_view = self.points[offset:offset + num_points]
+            offset += num_points
+            path = pydiffvg.Path(num_control_points = num_control_points, points = path_view, stroke_width = self.stroke_widths[i], is_closed = False)
+            self.shapes.append(path)
+            path_group = pydiffvg.ShapeGroup(shape_ids = torch.tensor([len(self.shapes) - 1]), fill_color = None, stroke_color = self.stroke_colors[i])
+            self.shape_groups.append(path_group)
+
     def get_opts(self):
         return self.opts
 
+    def get_state(self):
+        return {'path_sizes': self.path_sizes,
+                'points': self.points.detach().cpu(),
+                'stroke_widths': self.stroke_widths.detach().cpu(),
+                'stroke_colors': self.stroke_colors.detach().cpu()}
+
+    def set_state(self, state, opts=None):
+        if state['path_sizes'] == self.path_sizes:
+            with torch.no_grad():
+                self.points.copy_(state['points'])
+                self.stroke_widths.copy_(state['stroke_widths'])
+                self.stroke_colors.copy_(state['stroke_colors'])
+            return
+        # the random strokes had a different layout, so rebuild them
+        for name in ['points', 'stroke_widths', 'stroke_colors']:
+            old_param = getattr(self, name)
+            new_param = state[name].to(old_param.device).requires_grad_(True)
+            setattr(self, name, new_param)
+            migrate_optimizer_state(self.opts, old_param, new_param, None)
+        self.build_paths(state['path_sizes'])
+
     def rand_init(self, toksX, toksY):
         # TODO
         pass
@@ -123,6 +170,12 @@ class ClipDrawer(DrawingInterface):
         return 5
 
     def synth(self, cur_iteration):
+        if self.renderer == 'soft':
+            control_points = self.points[self.curve_index].unsqueeze(0)
+            img = softraster.render(control_points, self.stroke_widths.unsqueeze(0),
+                self.stroke_colors.unsqueeze(0), self.canvas_width, self.canvas_height)
+            self.img = img
+            return img
         render = pydiffvg.RenderFunction.apply
         scene_args = pydiffvg.RenderFunction.serialize_scene(\
             self.canvas_width, self.canvas_height, self.shapes, self.shape_groups)
@@ -147,10 +200,8 @@ class ClipDrawer(DrawingInterface):
 
     def clip_z(self):
         with torch.no_grad():
-            for path in self.shapes:
-                path.stroke_width.data.clamp_(1.0, self.max_width)
-            for group in self.shape_groups:
-                group.stroke_color.data.clamp_(0.0, 1.0)
+            self.stroke_widths.clamp_(1.0, self.max_width)
+            self.stroke_colors.clamp_(0.0, 1.0)
 
     def get_z(self):
         return None
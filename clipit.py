@@ -8,13 +8,19 @@ import sys
 import os
 import subprocess
 import glob
+import re
+import random
+import hashlib
+import json
+import threading
 from braceexpand import braceexpand
 from types import SimpleNamespace
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
 
 import os.path
 
-from omegaconf import OmegaConf
-
 import torch
 from torch import nn, optim
 from torch.nn import functional as F
@@ -23,14 +29,9 @@ from torchvision.transforms import functional as TF
 torch.backends.cudnn.benchmark = False		# NR: True is a bit faster, but can lead to OOM. False is more deterministic.
 #torch.use_deterministic_algorithms(True)		# NR: grid_sampler_2d_backward_cuda does not have a deterministic implementation
 
-from torch_optimizer import DiffGrad, AdamP, RAdam
-from perlin_numpy import generate_fractal_noise_2d
-
-from CLIP import clip
 import kornia
 import kornia.augmentation as K
 import numpy as np
-import imageio
 
 from PIL import ImageFile, Image, PngImagePlugin
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -40,17 +41,12 @@ global_padding_mode = 'reflection'
 global_aspect_width = 1
 global_spot_file = None
 
-from vqgan import VqganDrawer
-try:
-    from clipdrawer import ClipDrawer
-except ImportError:
-    pass
-    # print('clipdrawer not imported')
-try:
-    from pixeldrawer import PixelDrawer
-except ImportError:
-    pass
-    # print('pixeldrawer not imported')
+# drawers, CLIP, torch_optimizer and imageio are imported where they are
+# used so that --help and plain vqgan runs don't load what they don't need
+from animwriter import AnimationWriter
+from videoio import VideoReader, VideoWriter
+from resultcache import ResultCache, file_identity, settings_key
+from stagetimer import StageTimer
 
 # https://stackoverflow.com/a/39662359
 def isnotebook():
@@ -111,11 +107,46 @@ def old_random_noise_image(w,h):
     random_image = Image.fromarray(np.random.randint(0,255,(w,h,3),dtype=np.dtype('uint8')))
     return random_image
 
-def NormalizeData(data):
-    return (data - np.min(data)) / (np.max(data) - np.min(data))
-
-def random_noise_image(w,h):
-    # scale up roughly as power of 2
+def perlin_noise(channels, height, width, cell, generator=None, device=None):
+    # one octave of 2d perlin noise per channel, cell is the gradient
+    # grid spacing in pixels (same construction as perlin_numpy)
+    ys = torch.arange(height, device=device) / cell
+    xs = torch.arange(width, device=device) / cell
+    y0, x0 = ys.floor().long(), xs.floor().long()
+    fy, fx = (ys - y0)[:, None], (xs - x0)[None, :]
+    angles = 2 * math.pi * torch.rand(channels, int(y0[-1]) + 2, int(x0[-1]) + 2, generator=generator).to(device)
+    grad_y, grad_x = angles.cos(), angles.sin()
+
+    def corner(dy, dx):
+        rows, cols = (y0 + dy)[:, None], (x0 + dx)[None, :]
+        return grad_y[:, rows, cols] * (fy - dy) + grad_x[:, rows, cols] * (fx - dx)
+
+    ty = fy * fy * fy * (fy * (fy * 6 - 15) + 10)
+    tx = fx * fx * fx * (fx * (fx * 6 - 15) + 10)
+    n0 = corner(0, 0) * (1 - ty) + ty * corner(1, 0)
+    n1 = corner(0, 1) * (1 - ty) + ty * corner(1, 1)
+    return math.sqrt(2) * ((1 - tx) * n0 + tx * n1)
+
+def fractal_noise(channels, height, width, cell, octaves, generator=None, device=None):
+    noise = torch.zeros(channels, height, width, device=device)
+    amplitude = 1
+    for _ in range(octaves):
+        noise += amplitude * perlin_noise(channels, height, width, cell, generator, device)
+        cell = cell / 2
+        amplitude = amplitude / 2
+    return noise
+
+def random_noise_image(w, h, seed=None, noise_bank=None, noise_bank_size=16):
+    # with a noise bank, images are drawn from (and added to) a fixed
+    # set of seeded entries on disk so batch jobs can share them
+    if noise_bank is not None:
+        index = seed % noise_bank_size if seed is not None else random.randrange(noise_bank_size)
+        bank_file = os.path.join(noise_bank, f'noise_{w}x{h}_{index:03d}.png')
+        if os.path.exists(bank_file):
+            return Image.open(bank_file).convert('RGB')
+        seed = index
+
+    # noise features scale up roughly as power of 2 with the canvas
     if (w>1024 or h>1024):
         side, octp = 2048, 7
     elif (w>512 or h>512):
@@ -125,12 +156,23 @@ def random_noise_image(w,h):
     else:
         side, octp = 256, 4
 
-    nr = NormalizeData(generate_fractal_noise_2d((side, side), (32, 32), octp))
-    ng = NormalizeData(generate_fractal_noise_2d((side, side), (32, 32), octp))
-    nb = NormalizeData(generate_fractal_noise_2d((side, side), (32, 32), octp))
-    stack = np.dstack((nr,ng,nb))
-    substack = stack[:h, :w, :]
-    im = Image.fromarray((255.9 * stack).astype('uint8'))
+    generator = torch.Generator()
+    if seed is None:
+        generator.seed()
+    else:
+        generator.manual_seed(seed)
+    noise = fractal_noise(3, h, w, side / 32, octp, generator, device)
+    lo = noise.amin(dim=(1, 2), keepdim=True)
+    hi = noise.amax(dim=(1, 2), keepdim=True)
+    noise = (noise - lo) / (hi - lo)
+    im = Image.fromarray((255.9 * noise).permute(1, 2, 0).byte().cpu().numpy())
+
+    if noise_bank is not None:
+        # swapped in whole so concurrent jobs never read a partial entry
+        os.makedirs(noise_bank, exist_ok=True)
+        tmp_file = f'{bank_file}.{os.getpid()}.tmp'
+        im.save(tmp_file, format='PNG')
+        os.replace(tmp_file, bank_file)
     return im
 
 # testing
@@ -212,14 +254,17 @@ class MyRandomPerspective(K.RandomPerspective):
         )
 
 
-cached_spot_indexes = {}
+# spot masks keyed by everything they depend on, least recently used dropped first
+cached_spot_indexes = OrderedDict()
+max_cached_spot_indexes = 16
 def fetch_spot_indexes(sideX, sideY):
     global global_spot_file
 
-    # make sure image is loaded if we need it
-    cache_key = (sideX, sideY)
+    cache_key = (global_spot_file, global_aspect_width, sideX, sideY, str(device))
 
-    if cache_key not in cached_spot_indexes:
+    if cache_key in cached_spot_indexes:
+        cached_spot_indexes.move_to_end(cache_key)
+    else:
         if global_spot_file is not None:
             mask_image = Image.open(global_spot_file)
         elif global_aspect_width != 1:
@@ -229,13 +274,12 @@ def fetch_spot_indexes(sideX, sideY):
         # this is a one channel mask
         mask_image = mask_image.convert('RGB')
         mask_image = mask_image.resize((sideX, sideY), Image.LANCZOS)
-        mask_image_tensor = TF.to_tensor(mask_image)
-        # print("ONE CHANNEL ", mask_image_tensor.shape)
-        mask_indexes = mask_image_tensor.ge(0.5).to(device)
-        # print("GE ", mask_indexes.shape)
-        # sys.exit(0)
-        mask_indexes_off = mask_image_tensor.lt(0.5).to(device)
+        mask_image_tensor = TF.to_tensor(mask_image).unsqueeze(0).to(device)
+        mask_indexes = mask_image_tensor.ge(0.5)
+        mask_indexes_off = mask_image_tensor.lt(0.5)
         cached_spot_indexes[cache_key] = [mask_indexes, mask_indexes_off]
+        while len(cached_spot_indexes) > max_cached_spot_indexes:
+            cached_spot_indexes.popitem(last=False)
 
     return cached_spot_indexes[cache_key]
 
@@ -267,12 +311,13 @@ class MakeCutouts(nn.Module):
         self.av_pool = nn.AdaptiveAvgPool2d((self.cut_size, self.cut_size))
         self.max_pool = nn.AdaptiveMaxPool2d((self.cut_size, self.cut_size))
 
-    def forward(self, input, spot=None):
+    def forward(self, input, spot=None, cutn=None):
         global global_aspect_width
+        if cutn is None:
+            cutn = self.cutn
         sideY, sideX = input.shape[2:4]
         max_size = min(sideX, sideY)
         min_size = min(sideX, sideY, self.cut_size)
-        cutouts = []
         mask_indexes = None
 
         if spot is not None:
@@ -283,21 +328,17 @@ class MakeCutouts(nn.Module):
                 mask_indexes = spot_indexes[0]
             # print("Mask indexes ", mask_indexes)
 
-        for _ in range(self.cutn):
-            # Pooling
-            cutout = (self.av_pool(input) + self.max_pool(input))/2
+        # Pooling (the same for every cutout, the augmentations differ)
+        cutout = (self.av_pool(input) + self.max_pool(input))/2
 
-            if mask_indexes is not None:
-                cutout[0][mask_indexes] = 0.5
+        if mask_indexes is not None:
+            # masks every frame of the batch at once
+            cutout = torch.where(mask_indexes, cutout.new_tensor(0.5), cutout)
 
-            if global_aspect_width != 1:
-                cutout = kornia.geometry.transform.rescale(cutout, (1, 16/9))
-
-            # if i % 50 == 0 and _ == 0:
-            #     print(cutout.shape)
-            #     TF.to_pil_image(cutout[0].cpu()).save(f"cutout_im_{i:02d}_{spot}.png")
+        if global_aspect_width != 1:
+            cutout = kornia.geometry.transform.rescale(cutout, (1, 16/9))
 
-            cutouts.append(cutout)
+        cutouts = [cutout] * cutn
 
         if self.transforms is not None:
             # print("Cached transforms available, but I'm not smart enough to use them")
@@ -320,7 +361,7 @@ class MakeCutouts(nn.Module):
         # print(batch.shape, self.transforms.shape)
         
         if self.noise_fac:
-            facs = batch.new_empty([self.cutn, 1, 1, 1]).uniform_(0, self.noise_fac)
+            facs = batch.new_empty([batch.shape[0], 1, 1, 1]).uniform_(0, self.noise_fac)
             batch = batch + facs * torch.randn_like(batch)
         return batch
 
@@ -331,26 +372,195 @@ def resize_image(image, out_size):
     size = round((area * ratio)**0.5), round((area / ratio)**0.5)
     return image.resize(size, Image.LANCZOS)
 
+def resize_image_exact(image, out_size):
+    return image.resize(out_size, Image.LANCZOS)
+
+def open_image(path):
+    if 'http' in path:
+        return Image.open(urlopen(path))
+    return Image.open(path)
+
+# resized rgb images keyed by (path, mtime, size, resize), kept across
+# runs in the same process (eg: notebooks, animation re-runs). the lock
+# is held only around the dict, never while decoding
+cached_resized_images = OrderedDict()
+cached_resized_images_lock = threading.Lock()
+max_cached_resized_images = 256
+
+def load_resized_image(path, out_size, resize_fn):
+    mtime = None if 'http' in path else os.path.getmtime(path)
+    cache_key = (path, mtime, tuple(out_size), resize_fn.__name__)
+    with cached_resized_images_lock:
+        img = cached_resized_images.get(cache_key)
+        if img is not None:
+            cached_resized_images.move_to_end(cache_key)
+            return img
+    img = resize_fn(open_image(path).convert('RGB'), tuple(out_size))
+    with cached_resized_images_lock:
+        cached_resized_images[cache_key] = img
+        while len(cached_resized_images) > max_cached_resized_images:
+            cached_resized_images.popitem(last=False)
+    return img
+
+def load_images(paths, out_size, resize_fn=resize_image_exact, num_threads=None):
+    # decode and resize on a thread pool (PIL releases the GIL for both)
+    if num_threads is None:
+        num_threads = min(32, os.cpu_count() or 1)
+    if len(paths) <= 1 or num_threads <= 1:
+        return [load_resized_image(path, out_size, resize_fn) for path in paths]
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        return list(pool.map(lambda path: load_resized_image(path, out_size, resize_fn), paths))
+
+def load_image_tensor(paths, out_size, num_threads=None):
+    # all images at out_size as one NCHW tensor (0-1), moved to the device at once
+    images = load_images(paths, out_size, resize_image_exact, num_threads)
+    return torch.stack([TF.to_tensor(img) for img in images]).to(device)
+
+def latent_cache_file(args, img):
+    # latents depend only on the model weights and the (resized) pixels.
+    # the checkpoint is identified by path, size and mtime so a custom
+    # --vqgan_checkpoint (or a re-trained one) never reuses stale latents
+    checkpoint = args.vqgan_checkpoint
+    if checkpoint is None:
+        checkpoint = f'models/vqgan_{args.vqgan_model}.ckpt'
+    digest = hashlib.sha1(img.tobytes())
+    digest.update(json.dumps(file_identity(checkpoint)).encode())
+    return os.path.join(args.latent_cache, f'{args.vqgan_model}_{img.size[0]}x{img.size[1]}_{digest.hexdigest()}.pt')
+
+def encode_images(args, images):
+    # drawer latents for a list of PIL images, encoded args.encode_batch
+    # at a time. with --latent_cache they are also kept on disk so re-runs
+    # over the same frames skip the encoder entirely.
+    use_cache = args.latent_cache is not None and not (args.use_clipdraw or args.use_pixeldraw)
+    z_list = [None] * len(images)
+    if use_cache:
+        os.makedirs(args.latent_cache, exist_ok=True)
+        for i, img in enumerate(images):
+            cache_file = latent_cache_file(args, img)
+            if os.path.exists(cache_file):
+                z_list[i] = torch.load(cache_file, map_location=device)
+    missing = [i for i in range(len(images)) if z_list[i] is None]
+    if use_cache and len(images) > 0:
+        print(f"Latent cache: {len(images) - len(missing)} of {len(images)} images found")
+    for start in range(0, len(missing), args.encode_batch):
+        chunk = missing[start:start+args.encode_batch]
+        batch = torch.stack([TF.to_tensor(images[i]) for i in chunk]).to(device) * 2 - 1
+        with torch.no_grad():
+            z = drawer.get_z_from_tensor(batch)
+        if z is None:
+            # drawers without a latent encoder
+            continue
+        for j, i in enumerate(chunk):
+            z_list[i] = z[j:j+1]
+            if use_cache:
+                cache_file = latent_cache_file(args, images[i])
+                torch.save(z_list[i].cpu(), f'{cache_file}.tmp')
+                os.replace(f'{cache_file}.tmp', cache_file)
+    return z_list
+
+def make_starting_image(args, seed, sideX, sideY):
+    # returns the starting image and the resized rgba init image (or None)
+    # first - always start with noise or blank
+    if args.init_noise == 'pixels':
+        img = random_noise_image(args.size[0], args.size[1], seed, args.noise_bank, args.noise_bank_size)
+    elif args.init_noise == 'gradient':
+        img = random_gradient_image(args.size[0], args.size[1])
+    else:
+        img = Image.new(mode="RGB", size=(args.size[0], args.size[1]), color=(255, 255, 255))
+    starting_image = img.convert('RGB')
+    starting_image = starting_image.resize((sideX, sideY), Image.LANCZOS)
+
+    init_image_rgba = None
+    if args.init_image:
+        # now we might overlay an init image (init_image also can be recycled as overlay)
+        init_image = open_image(args.init_image)
+
+        # this version gets overlaid on the background (noise)
+        init_image_rgba = init_image.convert('RGBA')
+        init_image_rgba = init_image_rgba.resize((sideX, sideY), Image.LANCZOS)
+        top_image = init_image_rgba.copy()
+        if args.init_image_alpha and args.init_image_alpha >= 0:
+            top_image.putalpha(args.init_image_alpha)
+        starting_image.paste(top_image, (0, 0), top_image)
+    return starting_image, init_image_rgba
+
+# settings that don't change the final image
+result_cache_free_settings = ['output', 'result_cache', 'checkpoint_file', 'checkpoint_every', 'resume',
+                              'display_every', 'loader_threads', 'encode_batch', 'latent_cache',
+                              'timings', 'timing_trace', 'profile', 'profile_output']
+code_files = ['clipit.py', 'vqgan.py', 'pixeldrawer.py', 'clipdrawer.py', 'softraster.py', 'DrawingInterface.py']
+
+def result_cache_key(args):
+    settings = {k: v for k, v in vars(args).items() if k not in result_cache_free_settings}
+    files = [args.init_image, args.overlay_image, args.spot_file]
+    if args.vqgan_config is not None:
+        files += [args.vqgan_config, args.vqgan_checkpoint]
+    else:
+        files += [f'models/vqgan_{args.vqgan_model}.yaml', f'models/vqgan_{args.vqgan_model}.ckpt']
+    if args.target_images is not None:
+        files += real_glob(args.target_images)
+    if args.image_labels is not None:
+        files += real_glob(args.image_labels)
+    files += [parse_prompt(prompt)[0] for prompt in args.image_prompts]
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    return settings_key(settings, files, [os.path.join(code_dir, f) for f in code_files])
+
+def fetch_cached_result(args):
+    # True if the finished result was copied out of the result cache
+    global result_cache, result_cache_entry
+
+    result_cache = ResultCache(args.result_cache)
+    result_cache_entry = result_cache_key(args)
+    metadata = result_cache.lookup(result_cache_entry)
+    stats = result_cache.stats()
+    hit_str = 'hit' if metadata is not None else 'miss'
+    print(f"Result cache {hit_str} (hits: {stats['hits']}, misses: {stats['misses']})")
+    if metadata is None:
+        return False
+    result_cache.fetch(result_cache_entry, 'output.png', args.output)
+    if args.checkpoint_every:
+        result_cache.fetch(result_cache_entry, 'checkpoint.ckpt', args.checkpoint_file)
+    return True
+
+def store_cached_result(args):
+    checkpoint_file = args.checkpoint_file if args.checkpoint_every else None
+    result_cache.store(result_cache_entry,
+        {'output.png': args.output, 'checkpoint.ckpt': checkpoint_file},
+        {'settings': vars(args), 'iterations': cur_iteration, 'run': run_metadata})
+
 def do_init(args):
     global opts, perceptors, normalize, cutoutsTable, cutoutSizeTable
     global z_orig, z_targets, z_labels, init_image_tensor, target_image_tensor
-    global gside_X, gside_Y, overlay_image_rgba
+    global gside_X, gside_Y, overlay_image_rgba, gtoks_X, gtoks_Y
     global pmsTable, pImages, device, spotPmsTable, spotOffPmsTable
-    global drawer
+    global drawer, result_cache_hit, timer, cut_schedule, run_seed
+
+    result_cache_hit = args.result_cache is not None and fetch_cached_result(args)
+    if result_cache_hit:
+        # nothing to set up, do_run only reports the cached result
+        return
+
+    timer = StageTimer(args.timings, args.timing_trace)
+    if args.profile is not None:
+        timer.set_profile(args.profile[0], args.profile[1], args.profile_output)
 
     # Do it (init that is)
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
     if args.use_clipdraw:
-        drawer = ClipDrawer(args.size[0], args.size[1], args.strokes)
+        from clipdrawer import ClipDrawer
+        drawer = ClipDrawer(args.size[0], args.size[1], args.strokes, args.clipdraw_renderer)
     elif args.use_pixeldraw:
+        from pixeldrawer import PixelDrawer
         if global_aspect_width == 1:
             drawer = PixelDrawer(args.size[0], args.size[1], args.do_mono, [40, 40])
         else:
             drawer = PixelDrawer(args.size[0], args.size[1], args.do_mono)
     else:
+        from vqgan import VqganDrawer
         drawer = VqganDrawer(args.vqgan_model)
-    drawer.load_model(args.vqgan_config, args.vqgan_checkpoint, device)
+    with timer.stage('load_model'):
+        drawer.load_model(args.vqgan_config, args.vqgan_checkpoint, device)
     num_resolutions = drawer.get_num_resolutions()
     # print("-----------> NUMR ", num_resolutions)
 
@@ -363,16 +573,20 @@ def do_init(args):
     # save sideX, sideY in globals (need if using overlay)
     gside_X = sideX
     gside_Y = sideY
+    gtoks_X = toksX
+    gtoks_Y = toksY
 
-    for clip_model in args.clip_models:
-        perceptor = clip.load(clip_model, jit=jit)[0].eval().requires_grad_(False).to(device)
-        perceptors[clip_model] = perceptor
+    from CLIP import clip
+    with timer.stage('load_clip'):
+        for clip_model in args.clip_models:
+            perceptor = clip.load(clip_model, jit=jit)[0].eval().requires_grad_(False).to(device)
+            perceptors[clip_model] = perceptor
 
-        cut_size = perceptor.visual.input_resolution
-        cutoutSizeTable[clip_model] = cut_size
-        if not cut_size in cutoutsTable:    
-            make_cutouts = MakeCutouts(cut_size, args.num_cuts, cut_pow=args.cut_pow)
-            cutoutsTable[cut_size] = make_cutouts
+            cut_size = perceptor.visual.input_resolution
+            cutoutSizeTable[clip_model] = cut_size
+            if not cut_size in cutoutsTable:    
+                make_cutouts = MakeCutouts(cut_size, args.num_cuts, cut_pow=args.cut_pow)
+                cutoutsTable[cut_size] = make_cutouts
 
     init_image_tensor = None
     target_image_tensor = None
@@ -380,35 +594,10 @@ def do_init(args):
     # Image initialisation
     if args.init_image or args.init_noise:
         # setup init image wih pil
-        # first - always start with noise or blank
-        if args.init_noise == 'pixels':
-            img = random_noise_image(args.size[0], args.size[1])
-        elif args.init_noise == 'gradient':
-            img = random_gradient_image(args.size[0], args.size[1])
-        else:
-            img = Image.new(mode="RGB", size=(args.size[0], args.size[1]), color=(255, 255, 255))
-        starting_image = img.convert('RGB')
-        starting_image = starting_image.resize((sideX, sideY), Image.LANCZOS)
-
+        starting_image, init_image_rgba = make_starting_image(args, args.seed, sideX, sideY)
         if args.init_image:
-            # now we might overlay an init image (init_image also can be recycled as overlay)
-            if 'http' in args.init_image:
-              init_image = Image.open(urlopen(args.init_image))
-            else:
-              init_image = Image.open(args.init_image)
             # this version is needed potentially for the loss function
-            init_image_rgb = init_image.convert('RGB')
-            init_image_rgb = init_image_rgb.resize((sideX, sideY), Image.LANCZOS)
-            init_image_tensor = TF.to_tensor(init_image_rgb)
-            init_image_tensor = init_image_tensor.to(device).unsqueeze(0)
-
-            # this version gets overlaid on the background (noise)
-            init_image_rgba = init_image.convert('RGBA')
-            init_image_rgba = init_image_rgba.resize((sideX, sideY), Image.LANCZOS)
-            top_image = init_image_rgba.copy()
-            if args.init_image_alpha and args.init_image_alpha >= 0:
-                top_image.putalpha(args.init_image_alpha)
-            starting_image.paste(top_image, (0, 0), top_image)
+            init_image_tensor = load_image_tensor([args.init_image], (sideX, sideY))
 
         starting_image.save("starting_image.png")
         starting_tensor = TF.to_tensor(starting_image)
@@ -419,7 +608,6 @@ def do_init(args):
         print("intit_tensor", init_tensor.shape)
         print("intit_tensor", init_tensor)
         drawer.init_from_tensor(init_tensor)
-        #drawer.half_shape()
 
     else:
         # untested
@@ -439,39 +627,32 @@ def do_init(args):
             overlay_image_rgba.putalpha(args.overlay_alpha)
         overlay_image_rgba.save('overlay_image.png')
 
-    if args.target_images is not None:
-        z_targets = []
-        filelist = real_glob(args.target_images)
-        for target_image in filelist:
-            target_image = Image.open(target_image)
-            target_image_rgb = target_image.convert('RGB')
-            target_image_rgb = target_image_rgb.resize((sideX, sideY), Image.LANCZOS)
-            target_image_tensor_local = TF.to_tensor(target_image_rgb)
-            target_image_tensor = target_image_tensor_local.to(device).unsqueeze(0) * 2 - 1
-            z_target = drawer.get_z_from_tensor(target_image_tensor)
-            z_targets.append(z_target)
-
-    if args.image_labels is not None:
-        z_labels = []
-        filelist = real_glob(args.image_labels)
-        cur_labels = []
-        for image_label in filelist:
-            image_label = Image.open(image_label)
-            image_label_rgb = image_label.convert('RGB')
-            image_label_rgb = image_label_rgb.resize((sideX, sideY), Image.LANCZOS)
-            image_label_rgb_tensor = TF.to_tensor(image_label_rgb)
-            image_label_rgb_tensor = image_label_rgb_tensor.to(device).unsqueeze(0) * 2 - 1
-            z_label = drawer.get_z_from_tensor(image_label_rgb_tensor)
-            cur_labels.append(z_label)
-        image_embeddings = torch.stack(cur_labels)
-        print("Processing labels: ", image_embeddings.shape)
-        image_embeddings /= image_embeddings.norm(dim=-1, keepdim=True)
-        image_embeddings = image_embeddings.mean(dim=0)
-        image_embeddings /= image_embeddings.norm()
-        z_labels.append(image_embeddings.unsqueeze(0))
+    with timer.stage('load_images'):
+        if args.target_images is not None:
+            filelist = real_glob(args.target_images)
+            target_images = load_images(filelist, (sideX, sideY), num_threads=args.loader_threads)
+            z_targets = encode_images(args, target_images)
+            if len(target_images) > 0:
+                target_image_tensor = TF.to_tensor(target_images[-1]).unsqueeze(0).to(device) * 2 - 1
+
+        if args.image_labels is not None:
+            z_labels = []
+            filelist = real_glob(args.image_labels)
+            label_images = load_images(filelist, (sideX, sideY), num_threads=args.loader_threads)
+            cur_labels = encode_images(args, label_images)
+            image_embeddings = torch.stack(cur_labels)
+            print("Processing labels: ", image_embeddings.shape)
+            image_embeddings /= image_embeddings.norm(dim=-1, keepdim=True)
+            image_embeddings = image_embeddings.mean(dim=0)
+            image_embeddings /= image_embeddings.norm()
+            z_labels.append(image_embeddings.unsqueeze(0))
 
     z_orig = drawer.get_z_copy()
 
+    # coarse to fine: start optimizing at the first scale of the schedule
+    if args.resolution_schedule is not None:
+        apply_resolution_stage(args, 0)
+
     pmsTable = {}
     spotPmsTable = {}
     spotOffPmsTable = {}
@@ -483,52 +664,51 @@ def do_init(args):
     normalize = transforms.Normalize(mean=[0.48145466, 0.4578275, 0.40821073],
                                       std=[0.26862954, 0.26130258, 0.27577711])
 
-    # CLIP tokenize/encode
-    # NR: Weights / blending
-    for prompt in args.prompts:
-        for clip_model in args.clip_models:
-            pMs = pmsTable[clip_model]
-            perceptor = perceptors[clip_model]
-            txt, weight, stop = parse_prompt(prompt)
-            embed = perceptor.encode_text(clip.tokenize(txt).to(device)).float()
-            pMs.append(Prompt(embed, weight, stop).to(device))
-
-    for prompt in args.spot_prompts:
-        for clip_model in args.clip_models:
-            pMs = spotPmsTable[clip_model]
-            perceptor = perceptors[clip_model]
-            txt, weight, stop = parse_prompt(prompt)
-            embed = perceptor.encode_text(clip.tokenize(txt).to(device)).float()
-            pMs.append(Prompt(embed, weight, stop).to(device))
-
-    for prompt in args.spot_prompts_off:
-        for clip_model in args.clip_models:
-            pMs = spotOffPmsTable[clip_model]
-            perceptor = perceptors[clip_model]
-            txt, weight, stop = parse_prompt(prompt)
-            embed = perceptor.encode_text(clip.tokenize(txt).to(device)).float()
-            pMs.append(Prompt(embed, weight, stop).to(device))
-
-    for label in args.labels:
-        for clip_model in args.clip_models:
-            pMs = pmsTable[clip_model]
-            perceptor = perceptors[clip_model]
-            txt, weight, stop = parse_prompt(label)
-            texts = [template.format(txt) for template in imagenet_templates] #format with class
-            print(f"Tokenizing all of {texts}")
-            texts = clip.tokenize(texts).to(device) #tokenize
-            class_embeddings = perceptor.encode_text(texts) #embed with text encoder
-            class_embeddings /= class_embeddings.norm(dim=-1, keepdim=True)
-            class_embedding = class_embeddings.mean(dim=0)
-            class_embedding /= class_embedding.norm()
-            pMs.append(Prompt(class_embedding.unsqueeze(0), weight, stop).to(device))
-
-    for prompt in args.image_prompts:
-        path, weight, stop = parse_prompt(prompt)
-        img = Image.open(path)
-        pil_image = img.convert('RGB')
-        img = resize_image(pil_image, (sideX, sideY))
-        pImages.append(TF.to_tensor(img).unsqueeze(0).to(device))
+    with timer.stage('encode_text'):
+        # CLIP tokenize/encode
+        # NR: Weights / blending
+        for prompt in args.prompts:
+            for clip_model in args.clip_models:
+                pMs = pmsTable[clip_model]
+                perceptor = perceptors[clip_model]
+                txt, weight, stop = parse_prompt(prompt)
+                embed = perceptor.encode_text(clip.tokenize(txt).to(device)).float()
+                pMs.append(Prompt(embed, weight, stop).to(device))
+
+        for prompt in args.spot_prompts:
+            for clip_model in args.clip_models:
+                pMs = spotPmsTable[clip_model]
+                perceptor = perceptors[clip_model]
+                txt, weight, stop = parse_prompt(prompt)
+                embed = perceptor.encode_text(clip.tokenize(txt).to(device)).float()
+                pMs.append(Prompt(embed, weight, stop).to(device))
+
+        for prompt in args.spot_prompts_off:
+            for clip_model in args.clip_models:
+                pMs = spotOffPmsTable[clip_model]
+                perceptor = perceptors[clip_model]
+                txt, weight, stop = parse_prompt(prompt)
+                embed = perceptor.encode_text(clip.tokenize(txt).to(device)).float()
+                pMs.append(Prompt(embed, weight, stop).to(device))
+
+        for label in args.labels:
+            for clip_model in args.clip_models:
+                pMs = pmsTable[clip_model]
+                perceptor = perceptors[clip_model]
+                txt, weight, stop = parse_prompt(label)
+                texts = [template.format(txt) for template in imagenet_templates] #format with class
+                print(f"Tokenizing all of {texts}")
+                texts = clip.tokenize(texts).to(device) #tokenize
+                class_embeddings = perceptor.encode_text(texts) #embed with text encoder
+                class_embeddings /= class_embeddings.norm(dim=-1, keepdim=True)
+                class_embedding = class_embeddings.mean(dim=0)
+                class_embedding /= class_embedding.norm()
+                pMs.append(Prompt(class_embedding.unsqueeze(0), weight, stop).to(device))
+
+    with timer.stage('load_images'):
+        prompt_paths = [parse_prompt(prompt)[0] for prompt in args.image_prompts]
+        for img in load_images(prompt_paths, (sideX, sideY), resize_image, args.loader_threads):
+            pImages.append(TF.to_tensor(img).unsqueeze(0).to(device))
 
     for seed, weight in zip(args.noise_prompt_seeds, args.noise_prompt_weights):
         gen = torch.Generator().manual_seed(seed)
@@ -550,14 +730,26 @@ def do_init(args):
         elif args.optimiser == "Adamax":
             opt = optim.Adamax([z], lr=args.step_size)	# LR=0.5+?
         elif args.optimiser == "DiffGrad":
+            from torch_optimizer import DiffGrad
             opt = DiffGrad([z], lr=args.step_size)		# LR=2+?
         elif args.optimiser == "AdamP":
+            from torch_optimizer import AdamP
             opt = AdamP([z], lr=args.step_size)		# LR=2+?
         elif args.optimiser == "RAdam":
+            from torch_optimizer import RAdam
             opt = RAdam([z], lr=args.step_size)		# LR=2+?
 
         opts = [opt]
 
+    if args.memory_budget is not None:
+        with timer.stage('auto_cuts'):
+            auto_num_cuts(args)
+
+    # built after auto tuning, num_cuts is the most the schedule goes up to
+    if args.cut_schedule is not None:
+        min_cuts = args.cut_schedule_min or max(min_num_cuts, args.num_cuts // 4)
+        cut_schedule = CutSchedule(args.cut_schedule, min_cuts, args.iterations)
+
     # Output for the user
     print('Using device:', device)
     print('Optimising using:', args.optimiser)
@@ -582,6 +774,8 @@ def do_init(args):
         seed = args.seed
     torch.manual_seed(seed)
     print('Using seed:', seed)
+    run_seed = seed
+    timer.end_iteration('init')
 
 
 # dreaded globals (for now)
@@ -602,32 +796,23 @@ spotOffPmsTable = None
 pImages = None
 gside_X=None
 gside_Y=None
+gtoks_X=None
+gtoks_Y=None
 overlay_image_rgba=None
 device=None
 cur_iteration=None
-cur_anim_index=None
 anim_output_files=[]
-anim_cur_zs=[]
-anim_next_zs=[]
-
-def make_gif(args, iter):
-    gif_output = os.path.join(args.animation_dir, "anim.gif")
-    if os.path.exists(gif_output):
-        os.remove(gif_output)
-    cmd = ['ffmpeg', '-framerate', '10', '-pattern_type', 'glob',
-           '-i', f"{args.animation_dir}/*.png", '-loop', '0', gif_output]
-    try:
-        output = subprocess.check_output(cmd)
-    except subprocess.CalledProcessError as cpe:
-        output = cpe.output
-        print("Ignoring non-zero exit: ", output)
-
-    return gif_output
-
-# !ffmpeg \
-#   -framerate 10 -pattern_type glob \
-#   -i '{animation_output}/*_*.png' \
-#   -loop 0 {animation_output}/final.gif
+anim_z_targets=None
+anim_writer=None
+result_cache=None
+result_cache_entry=None
+result_cache_hit=False
+timer=StageTimer()
+# degradations during the run (eg: fewer cuts after running out of memory)
+run_metadata={}
+cut_schedule=None
+early_stopper=None
+run_seed=None
 
 @torch.no_grad()
 def checkin(args, iter, losses):
@@ -635,54 +820,156 @@ def checkin(args, iter, losses):
     losses_str = ', '.join(f'{loss.item():g}' for loss in losses)
     writestr = f'iter: {iter}, loss: {sum(losses).item():g}, losses: {losses_str}'
     if args.animation_dir is not None:
-        writestr = f'anim: {cur_anim_index}/{len(anim_output_files)} {writestr}'
+        writestr = f'anim: {len(anim_output_files)} frames {writestr}'
     tqdm.write(writestr)
     info = PngImagePlugin.PngInfo()
     info.add_text('comment', f'{args.prompts}')
-    img = drawer.to_image()
-    if cur_anim_index is None:
-        outfile = args.output
-    else:
-        outfile = anim_output_files[cur_anim_index]
-    img.save(outfile, pnginfo=info)
-    if cur_anim_index == len(anim_output_files) - 1:
-        # save gif
-        gif_output = make_gif(args, iter)
+    if run_metadata:
+        info.add_text('clipit_run', json.dumps(run_metadata))
+    if args.animation_dir is not None:
+        # all frames are in the drawer as one batch
+        for i, img in enumerate(drawer.to_images()):
+            img.save(anim_output_files[i], pnginfo=info)
+            anim_writer.update(i, img)
+        # save gif (written in the background)
+        anim_writer.write()
         if IS_NOTEBOOK and iter % args.display_every == 0:
+            gif_output = anim_writer.flush()
             clear_output()
             display.display(display.Image(open(gif_output,'rb').read()))
-    if IS_NOTEBOOK and iter % args.display_every == 0:
-        if cur_anim_index is None or iter == 0:
+    else:
+        img = drawer.to_image()
+        outfile = args.output
+        img.save(outfile, pnginfo=info)
+        if IS_NOTEBOOK and iter % args.display_every == 0:
             display.display(display.Image(outfile))
 
-def ascend_txt(args):
-    global cur_iteration, cur_anim_index, perceptors, normalize, cutoutsTable, cutoutSizeTable
-    global z_orig, z_targets, z_labels, init_image_tensor, target_image_tensor, drawer
-    global pmsTable, spotPmsTable, spotOffPmsTable, global_padding_mode
+def get_rng_states():
+    states = {'torch': torch.get_rng_state(), 'random': random.getstate(), 'numpy': np.random.get_state()}
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
 
-    out = drawer.synth(cur_iteration);
+def set_rng_states(states):
+    torch.set_rng_state(states['torch'])
+    random.setstate(states['random'])
+    np.random.set_state(states['numpy'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
 
-    result = []
+# settings that can differ on resume without affecting the result
+resume_free_settings = ['resume', 'checkpoint_every', 'checkpoint_file', 'iterations', 'save_every', 'display_every',
+                        'timings', 'timing_trace', 'profile', 'profile_output']
 
-    if (cur_iteration%2 == 0):
-        global_padding_mode = 'reflection'
-    else:
-        global_padding_mode = 'border'
+@torch.no_grad()
+def save_checkpoint(args, iteration):
+    # iteration is the next one to run
+    checkpoint = {
+        'iteration': iteration,
+        'drawer': drawer.get_state(),
+        'opts': [opt.state_dict() for opt in opts],
+        'rng': get_rng_states(),
+        'settings': dict(vars(args)),
+        'run': run_metadata,
+    }
+    # controllers that adapt to the run so far
+    if cut_schedule is not None:
+        checkpoint['cut_schedule'] = cut_schedule.get_state()
+    if early_stopper is not None:
+        checkpoint['early_stopper'] = early_stopper.get_state()
+    if args.best_of is not None:
+        # the surviving candidates' own inits
+        checkpoint['z_orig'] = z_orig
+    # write next to the target so a crash never leaves a broken checkpoint
+    tmp_file = f'{args.checkpoint_file}.tmp'
+    torch.save(checkpoint, tmp_file)
+    os.replace(tmp_file, args.checkpoint_file)
 
-    cur_cutouts = {}
-    cur_spot_cutouts = {}
-    cur_spot_off_cutouts = {}
-    for cutoutSize in cutoutsTable:
-        make_cutouts = cutoutsTable[cutoutSize]
-        cur_cutouts[cutoutSize] = make_cutouts(out)
+@torch.no_grad()
+def load_checkpoint(args):
+    # restores a run saved by save_checkpoint, returns the iteration to continue from
+    global z_orig
+    checkpoint = torch.load(args.checkpoint_file, map_location='cpu')
+    changed = [k for k, v in checkpoint['settings'].items()
+               if k not in resume_free_settings and k not in ['num_cuts', 'cut_batch_size']
+               and getattr(args, k, None) != v]
+    if changed:
+        print("Warning: settings differ from the checkpoint:", ', '.join(changed))
+    drawer.set_state(checkpoint['drawer'], opts)
+    for opt, opt_state in zip(opts, checkpoint['opts']):
+        opt.load_state_dict(opt_state)
+    if 'z_orig' in checkpoint:
+        z_orig = checkpoint['z_orig'].to(device)
+    if cut_schedule is not None and 'cut_schedule' in checkpoint:
+        cut_schedule.set_state(checkpoint['cut_schedule'])
+    if early_stopper is not None and 'early_stopper' in checkpoint:
+        early_stopper.set_state(checkpoint['early_stopper'])
+    set_rng_states(checkpoint['rng'])
+    run_metadata.update(checkpoint.get('run', {}))
+    # keep going with the cuts the run was degraded to
+    apply_degradations(args)
+    print(f"Resuming from {args.checkpoint_file} at iteration {checkpoint['iteration']}")
+    return checkpoint['iteration']
+
+def resolution_stage_scale(args, iteration):
+    # scale of the last stage that has started by this iteration
+    cur_scale = 1
+    for start_iteration, scale in args.resolution_schedule:
+        if iteration >= start_iteration:
+            cur_scale = scale
+    return cur_scale
+
+def apply_resolution_stage(args, iteration):
+    global drawer, opts, gtoks_X, gtoks_Y
+
+    for start_iteration, scale in args.resolution_schedule:
+        if iteration != start_iteration:
+            continue
+        if args.use_pixeldraw:
+            num_rows = max(1, round(drawer.end_num_rows * scale))
+            num_cols = max(1, round(drawer.end_num_cols * scale))
+            if iteration > 0:
+                tqdm.write(f'resolution stage {scale:g} ({num_cols}x{num_rows} cells) at iter {iteration}')
+            drawer.resize_grid(num_rows, num_cols)
+        else:
+            toksX = max(1, round(gtoks_X * scale))
+            toksY = max(1, round(gtoks_Y * scale))
+            if iteration > 0:
+                tqdm.write(f'resolution stage {scale:g} ({toksX}x{toksY} tokens) at iter {iteration}')
+            drawer.resize_z(toksX, toksY, opts)
+
+def match_z(ref_z):
+    # reference latents are at the final resolution, but the drawer
+    # can be optimizing a coarser z during a resolution schedule
+    cur_shape = drawer.get_z().shape[-2:]
+    if ref_z.shape[-2:] != cur_shape:
+        ref_z = F.adaptive_avg_pool2d(ref_z, cur_shape)
+    return ref_z
+
+def match_image(ref_image, out):
+    if ref_image.shape[-2:] != out.shape[-2:]:
+        ref_image = F.adaptive_avg_pool2d(ref_image, out.shape[-2:])
+    return ref_image
+
+def clip_losses(args, out, cutn):
+    # prompt losses for cutn cutouts of out, one per prompt for every clip model
+    result = []
 
-    if args.spot_prompts:
+    with timer.stage('cutouts'):
+        cur_cutouts = {}
+        cur_spot_cutouts = {}
+        cur_spot_off_cutouts = {}
         for cutoutSize in cutoutsTable:
-            cur_spot_cutouts[cutoutSize] = make_cutouts(out, spot=1)
+            make_cutouts = cutoutsTable[cutoutSize]
+            cur_cutouts[cutoutSize] = make_cutouts(out, cutn=cutn)
 
-    if args.spot_prompts_off:
-        for cutoutSize in cutoutsTable:
-            cur_spot_off_cutouts[cutoutSize] = make_cutouts(out, spot=0)
+        if args.spot_prompts:
+            for cutoutSize in cutoutsTable:
+                cur_spot_cutouts[cutoutSize] = make_cutouts(out, spot=1, cutn=cutn)
+
+        if args.spot_prompts_off:
+            for cutoutSize in cutoutsTable:
+                cur_spot_off_cutouts[cutoutSize] = make_cutouts(out, spot=0, cutn=cutn)
 
     for clip_model in args.clip_models:
         perceptor = perceptors[clip_model]
@@ -690,101 +977,160 @@ def ascend_txt(args):
         transient_pMs = []
 
         if args.spot_prompts:
-            iii_s = perceptor.encode_image(normalize( cur_spot_cutouts[cutoutSize] )).float()
+            with timer.stage(f'encode_image/{clip_model}'):
+                iii_s = perceptor.encode_image(normalize( cur_spot_cutouts[cutoutSize] )).float()
             spotPms = spotPmsTable[clip_model]
             for prompt in spotPms:
                 result.append(prompt(iii_s))
 
         if args.spot_prompts_off:
-            iii_so = perceptor.encode_image(normalize( cur_spot_off_cutouts[cutoutSize] )).float()
+            with timer.stage(f'encode_image/{clip_model}'):
+                iii_so = perceptor.encode_image(normalize( cur_spot_off_cutouts[cutoutSize] )).float()
             spotOffPms = spotOffPmsTable[clip_model]
             for prompt in spotOffPms:
                 result.append(prompt(iii_so))
 
         pMs = pmsTable[clip_model]
-        iii = perceptor.encode_image(normalize( cur_cutouts[cutoutSize] )).float()
-        for prompt in pMs:
-            result.append(prompt(iii))
+        with timer.stage(f'encode_image/{clip_model}'):
+            iii = perceptor.encode_image(normalize( cur_cutouts[cutoutSize] )).float()
+        with timer.stage('prompt_loss'):
+            for prompt in pMs:
+                result.append(prompt(iii))
 
         # If there are image prompts we make cutouts for those each time
         # so that they line up with the current cutouts from augmentation
-        make_cutouts = cutoutsTable[cutoutSize]
-        for timg in pImages:
-            # note: this caches and reuses the transforms - a bit of a hack but it works
-
-            if args.image_prompt_shuffle:
-                # print("Disabling cached transforms")
-                make_cutouts.transforms = None
-
-            # new way builds throwaway Prompts
-            batch = make_cutouts(timg)
-            embed = perceptor.encode_image(normalize(batch)).float()
-            if args.image_prompt_weight is not None:
-                transient_pMs.append(Prompt(embed, args.image_prompt_weight).to(device))
-            else:
-                transient_pMs.append(Prompt(embed).to(device))
-
-        for prompt in transient_pMs:
-            result.append(prompt(iii))
+        with timer.stage('image_prompts'):
+            make_cutouts = cutoutsTable[cutoutSize]
+            for timg in pImages:
+                # note: this caches and reuses the transforms - a bit of a hack but it works
+
+                if args.image_prompt_shuffle:
+                    # print("Disabling cached transforms")
+                    make_cutouts.transforms = None
+
+                # new way builds throwaway Prompts
+                # (one copy per frame so the cached transforms line up)
+                batch = make_cutouts(timg.expand(out.shape[0], -1, -1, -1), cutn=cutn)
+                embed = perceptor.encode_image(normalize(batch)).float()
+                if args.image_prompt_weight is not None:
+                    transient_pMs.append(Prompt(embed, args.image_prompt_weight).to(device))
+                else:
+                    transient_pMs.append(Prompt(embed).to(device))
+
+        with timer.stage('prompt_loss'):
+            for prompt in transient_pMs:
+                result.append(prompt(iii))
 
     for cutoutSize in cutoutsTable:
         # clear the transform "cache"
         make_cutouts = cutoutsTable[cutoutSize]
         make_cutouts.transforms = None
 
+    return result
+
+def ascend_txt(args):
+    global cur_iteration, perceptors, normalize, cutoutsTable, cutoutSizeTable
+    global z_orig, z_targets, z_labels, init_image_tensor, target_image_tensor, drawer
+    global pmsTable, spotPmsTable, spotOffPmsTable, global_padding_mode
+
+    with timer.stage('synth'):
+        out = drawer.synth(cur_iteration);
+
+    result = []
+
+    if (cur_iteration%2 == 0):
+        global_padding_mode = 'reflection'
+    else:
+        global_padding_mode = 'border'
+
+    num_cuts = args.num_cuts
+    if cut_schedule is not None:
+        num_cuts = cut_schedule.num_cuts(cur_iteration, num_cuts)
+    cut_batch_size = args.cut_batch_size
+    if cut_batch_size is None or cut_batch_size >= num_cuts:
+        result += clip_losses(args, out, num_cuts)
+    else:
+        # cuts go through clip in micro-batches: each one backpropagates
+        # into a detached copy of out right away (so only one batch of
+        # cutouts is alive at a time) and the summed gradient is handed
+        # to out once, below. losses are the cut weighted averages.
+        out_leaf = out.detach().requires_grad_(True)
+        totals = None
+        for start in range(0, num_cuts, cut_batch_size):
+            cutn = min(cut_batch_size, num_cuts - start)
+            losses = clip_losses(args, out_leaf, cutn)
+            if len(losses) == 0:
+                break
+            chunk_weight = cutn / num_cuts
+            with timer.stage('backward'):
+                (sum(losses) * chunk_weight).backward()
+            chunk_totals = [loss.detach() * chunk_weight for loss in losses]
+            totals = chunk_totals if totals is None else [a + b for a, b in zip(totals, chunk_totals)]
+        if totals is not None:
+            # zero valued, but its gradient wrt out is the accumulated one
+            surrogate = (out * out_leaf.grad).sum()
+            totals[0] = totals[0] + surrogate - surrogate.detach()
+            result += totals
+
+
+    # z can hold a batch (eg: animation frames), latent losses are
+    # computed per entry and averaged
+    cur_z = drawer.get_z()
+    if cur_z is not None:
+        z_flat = cur_z.reshape(cur_z.shape[0], -1)
+
     # main init_weight uses spherical loss
     if args.target_images is not None and args.target_image_weight > 0:
-        if cur_anim_index is None:
-            cur_z_targets = z_targets
-        else:
-            cur_z_targets = [ z_targets[cur_anim_index] ]
-        for z_target in cur_z_targets:
-            f = drawer.get_z().reshape(1,-1)
-            f2 = z_target.reshape(1,-1)
-            cur_loss = spherical_dist_loss(f, f2) * args.target_image_weight
+        if args.animation_dir is not None:
+            # every frame is pulled towards its own target
+            cur_loss = spherical_dist_loss(z_flat, anim_z_targets).mean() * args.target_image_weight
             result.append(cur_loss)
+        else:
+            for z_target in z_targets:
+                f2 = match_z(z_target).reshape(1,-1)
+                cur_loss = spherical_dist_loss(z_flat, f2).mean() * args.target_image_weight
+                result.append(cur_loss)
 
     if args.target_weight_pix:
         if target_image_tensor is None:
             print("OOPS TIT is 0")
         else:
-            cur_loss = F.l1_loss(out, target_image_tensor) * args.target_weight_pix
+            cur_loss = F.l1_loss(out, match_image(target_image_tensor, out).expand_as(out)) * args.target_weight_pix
             result.append(cur_loss)
 
     if args.image_labels is not None:
         for z_label in z_labels:
-            f = drawer.get_z().reshape(1,-1)
-            f2 = z_label.reshape(1,-1)
-            cur_loss = spherical_dist_loss(f, f2) * args.image_label_weight
+            f2 = match_z(z_label).reshape(1,-1)
+            cur_loss = spherical_dist_loss(z_flat, f2).mean() * args.image_label_weight
             result.append(cur_loss)
 
     # main init_weight uses spherical loss
     if args.init_weight:
-        f = drawer.get_z().reshape(1,-1)
-        f2 = z_orig.reshape(1,-1)
-        cur_loss = spherical_dist_loss(f, f2) * args.init_weight
+        # one init per best of candidate, otherwise shared by the batch
+        f2 = match_z(z_orig).reshape(z_orig.shape[0],-1)
+        cur_loss = spherical_dist_loss(z_flat, f2).mean() * args.init_weight
         result.append(cur_loss)
 
     # these three init_weight variants offer mse_loss, mse_loss in pixel space, and cos loss
     if args.init_weight_dist:
-        cur_loss = F.mse_loss(z, z_orig) * args.init_weight_dist / 2
+        cur_loss = F.mse_loss(cur_z, match_z(z_orig).expand_as(cur_z)) * args.init_weight_dist / 2
         result.append(cur_loss)
 
     if args.init_weight_pix:
         if init_image_tensor is None:
             print("OOPS IIT is 0")
         else:
-            cur_loss = F.l1_loss(out, init_image_tensor) * args.init_weight_pix / 2
+            cur_loss = F.l1_loss(out, match_image(init_image_tensor, out).expand_as(out)) * args.init_weight_pix / 2
             result.append(cur_loss)
 
     if args.init_weight_cos:
-        f = drawer.get_z().reshape(1,-1)
-        f2 = z_orig.reshape(1,-1)
-        y = torch.ones_like(f[0])
-        cur_loss = F.cosine_embedding_loss(f, f2, y) * args.init_weight_cos
+        f2 = match_z(z_orig).reshape(z_orig.shape[0],-1).expand_as(z_flat)
+        y = torch.ones_like(z_flat[:, 0])
+        cur_loss = F.cosine_embedding_loss(z_flat, f2, y) * args.init_weight_cos
         result.append(cur_loss)
 
     if args.make_video:    
+        import imageio
         img = np.array(out.mul(255).clamp(0, 255)[0].cpu().detach().numpy().astype(np.uint8))[:,:,:]
         img = np.transpose(img, (1, 2, 0))
         imageio.imwrite(f'./steps/frame_{cur_iteration:04d}.png', np.array(img))
@@ -805,28 +1151,183 @@ def re_average_z(args):
     cur_z_image = cur_z_image.resize((gside_X, gside_Y), Image.LANCZOS)
     drawer.reapply_from_tensor(TF.to_tensor(cur_z_image).to(device).unsqueeze(0) * 2 - 1)
 
+class EarlyStopper:
+    # stops when the smoothed total loss hasn't improved by min_delta
+    # for patience iterations (and at least min_iterations have run)
+    def __init__(self, patience, min_delta=0., min_iterations=0, smoothing=0.9):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.min_iterations = min_iterations
+        self.smoothing = smoothing
+        self.smoothed_loss = None
+        self.best_loss = None
+        self.best_iteration = None
+
+    def update(self, iteration, loss):
+        # returns True when the run should stop
+        if self.smoothed_loss is None:
+            self.smoothed_loss = loss
+        else:
+            self.smoothed_loss = self.smoothing * self.smoothed_loss + (1 - self.smoothing) * loss
+        if self.best_loss is None or self.smoothed_loss < self.best_loss - self.min_delta:
+            self.best_loss = self.smoothed_loss
+            self.best_iteration = iteration
+        return iteration >= self.min_iterations and iteration - self.best_iteration >= self.patience
+
+    # only the running state, the settings come from args on resume
+    def get_state(self):
+        return {'smoothed_loss': self.smoothed_loss, 'best_loss': self.best_loss,
+                'best_iteration': self.best_iteration}
+
+    def set_state(self, state):
+        self.__dict__.update(state)
+
+class CutSchedule:
+    # number of cuts per iteration, up to the run's num_cuts: early
+    # iterations only need a coarse signal, detail needs many cuts
+    #   ramp: linear from min_cuts to num_cuts over the run
+    #   step: min_cuts, doubled at evenly spaced stages up to num_cuts
+    #   loss: min_cuts, doubled whenever the smoothed loss improves less
+    #         than min_improvement (relative) over a window of iterations
+    def __init__(self, mode, min_cuts, iterations, window=20, min_improvement=0.01, smoothing=0.9):
+        self.mode = mode
+        self.min_cuts = min_cuts
+        self.iterations = iterations
+        self.window = window
+        self.min_improvement = min_improvement
+        self.smoothing = smoothing
+        self.loss_cuts = min_cuts
+        self.smoothed_loss = None
+        self.window_loss = None
+        self.window_start = 0
+        self.last_cuts = None
+        self.total_cuts = 0
+        self.total_iterations = 0
+
+    def num_cuts(self, iteration, max_cuts):
+        min_cuts = min(self.min_cuts, max_cuts)
+        progress = min(1, iteration / max(1, self.iterations))
+        if self.mode == 'ramp':
+            num_cuts = round(min_cuts + progress * (max_cuts - min_cuts))
+        elif self.mode == 'step':
+            num_steps = max(0, int(math.log2(max_cuts / min_cuts)))
+            step = min(num_steps, int(progress * (num_steps + 1)))
+            num_cuts = max_cuts if step == num_steps else min_cuts * 2**step
+        else:
+            num_cuts = self.loss_cuts
+        num_cuts = max(min_cuts, min(max_cuts, num_cuts))
+        self.last_cuts = num_cuts
+        return num_cuts
+
+    # only the running state, the settings come from args on resume
+    # (eg: --iterations can change)
+    def get_state(self):
+        return {'loss_cuts': self.loss_cuts, 'smoothed_loss': self.smoothed_loss,
+                'window_loss': self.window_loss, 'window_start': self.window_start,
+                'last_cuts': self.last_cuts, 'total_cuts': self.total_cuts,
+                'total_iterations': self.total_iterations}
+
+    def set_state(self, state):
+        self.__dict__.update(state)
+
+    def record(self):
+        # usage counts completed iterations only, not out of memory retries
+        if self.last_cuts is not None:
+            self.total_cuts += self.last_cuts
+            self.total_iterations += 1
+
+    def update(self, iteration, loss):
+        if self.mode != 'loss':
+            return
+        if self.smoothed_loss is None:
+            self.smoothed_loss = loss
+        else:
+            self.smoothed_loss = self.smoothing * self.smoothed_loss + (1 - self.smoothing) * loss
+        if self.window_loss is None:
+            self.window_loss = self.smoothed_loss
+            self.window_start = iteration
+        elif iteration - self.window_start >= self.window:
+            improvement = (self.window_loss - self.smoothed_loss) / max(abs(self.window_loss), 1e-8)
+            if improvement < self.min_improvement:
+                self.loss_cuts *= 2
+            self.window_loss = self.smoothed_loss
+            self.window_start = iteration
+
 # torch.autograd.set_detect_anomaly(True)
     
 def train(args, cur_it):
     global drawer;
+    timer.begin_iteration(cur_it)
     for opt in opts:
         # opt.zero_grad(set_to_none=True)fg
         opt.zero_grad()
     lossAll = ascend_txt(args)
     
     if cur_it % args.save_every == 0:
-        checkin(args, cur_it, lossAll)
-
-    loss = sum(lossAll)
-    loss.backward()
-    for opt in opts:
-        opt.step()
+        with timer.stage('checkin'):
+            checkin(args, cur_it, lossAll)
+
+    with timer.stage('backward'):
+        loss = sum(lossAll)
+        loss.backward()
+    if cut_schedule is not None and cut_schedule.mode == 'loss':
+        cut_schedule.update(cur_it, loss.item())
+    with timer.stage('opt_step'):
+        for opt in opts:
+            opt.step()
+    if cut_schedule is not None:
+        cut_schedule.record()
 
     if args.overlay_every and cur_it != 0 and \
         (cur_it % (args.overlay_every + args.overlay_offset)) == 0:
-        re_average_z(args)
-
-    drawer.clip_z()    
+        with timer.stage('overlay'):
+            re_average_z(args)
+
+    with timer.stage('clip_z'):
+        drawer.clip_z()    
+    timer.end_iteration(cur_it)
+    return lossAll
+
+def degrade_after_oom(args, iteration):
+    # the failed step is retried from scratch: first with the cuts split
+    # into smaller micro-batches (same result, less memory), then with
+    # half the cuts once the micro-batches are as small as they get
+    for opt in opts:
+        opt.zero_grad()
+    torch.cuda.empty_cache()
+    cut_batch_size = min(args.cut_batch_size or args.num_cuts, args.num_cuts)
+    if cut_batch_size > min_num_cuts:
+        new_cut_batch_size = max(min_num_cuts, cut_batch_size // 2)
+        tqdm.write(f'out of memory at iter {iteration}, retrying with cut batches of {new_cut_batch_size} (was {cut_batch_size})')
+        event = {'iteration': iteration, 'cut_batch_size_from': cut_batch_size, 'cut_batch_size_to': new_cut_batch_size}
+        args.cut_batch_size = new_cut_batch_size
+    else:
+        num_cuts = max(min_num_cuts, args.num_cuts // 2)
+        tqdm.write(f'out of memory at iter {iteration}, retrying with {num_cuts} cuts (was {args.num_cuts})')
+        event = {'iteration': iteration, 'num_cuts_from': args.num_cuts, 'num_cuts_to': num_cuts}
+        args.num_cuts = num_cuts
+        set_num_cuts(num_cuts)
+    run_metadata.setdefault('oom_events', []).append(event)
+
+def apply_degradations(args):
+    # replays the recorded out of memory degradations (eg: on resume)
+    for event in run_metadata.get('oom_events', []):
+        if 'num_cuts_to' in event:
+            args.num_cuts = event['num_cuts_to']
+        if 'cut_batch_size_to' in event:
+            args.cut_batch_size = event['cut_batch_size_to']
+    set_num_cuts(args.num_cuts)
+
+def train_step(args, cur_it):
+    # train, but recover from running out of memory with fewer cuts
+    while True:
+        try:
+            return train(args, cur_it)
+        except RuntimeError as e:
+            if not is_oom_error(e) or args.num_cuts <= min_num_cuts:
+                raise e
+        # outside the except block so the failed step's tensors are freed
+        degrade_after_oom(args, cur_it)
 
 imagenet_templates = [
     "itap of a {}.",
@@ -838,18 +1339,183 @@ imagenet_templates = [
     "a photo of the small {}.",
 ]
 
+# cut counts used to fit the memory model, and the range auto tuning
+# (and out of memory recovery) picks from
+calibration_cuts = (8, 16)
+min_num_cuts = 4
+max_auto_cuts = 128
+
+def is_oom_error(e):
+    return isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+def set_num_cuts(num_cuts):
+    for make_cutouts in cutoutsTable.values():
+        make_cutouts.cutn = num_cuts
+
+def measure_peak_memory(args, num_cuts):
+    # peak cuda memory of one forward and backward pass with num_cuts,
+    # all in one batch. ascend_txt takes the count from args.num_cuts
+    saved_num_cuts, saved_cut_batch_size = args.num_cuts, args.cut_batch_size
+    args.num_cuts, args.cut_batch_size = num_cuts, None
+    set_num_cuts(num_cuts)
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    try:
+        loss = sum(ascend_txt(args))
+        loss.backward()
+        del loss
+    finally:
+        args.num_cuts, args.cut_batch_size = saved_num_cuts, saved_cut_batch_size
+        for opt in opts:
+            opt.zero_grad()
+    torch.cuda.synchronize(device)
+    return torch.cuda.max_memory_allocated(device)
+
+def auto_num_cuts(args):
+    # picks the largest num_cuts that fits the memory budget. peak memory
+    # is close to linear in the number of cuts (every cut goes through
+    # every CLIP model), so two short calibration passes give the fixed
+    # cost (models, drawer, prompts) and the cost per cut
+    global cur_iteration
+
+    if device.type != 'cuda':
+        print(f"Memory budget needs cuda, using {args.num_cuts} cuts")
+        return
+    if args.memory_budget == 'auto':
+        budget = 0.9 * torch.cuda.get_device_properties(device).total_memory
+    else:
+        budget = float(args.memory_budget) * 2**30
+
+    cur_iteration = 0
+    low, high = calibration_cuts
+    try:
+        peak_low = measure_peak_memory(args, low)
+        peak_high = measure_peak_memory(args, high)
+    except RuntimeError as e:
+        if not is_oom_error(e):
+            raise e
+        peak_low = peak_high = None
+    cur_iteration = None
+    for make_cutouts in cutoutsTable.values():
+        make_cutouts.transforms = None
+
+    if peak_high is None:
+        num_cuts = min_num_cuts
+        print(f"Calibration ran out of memory, using {num_cuts} cuts (try a smaller size or fewer clip models)")
+    else:
+        per_cut = max((peak_high - peak_low) / (high - low), 1)
+        fixed = peak_low - per_cut * low
+        # animation frames (and best of candidates) are optimized as one
+        # batch, each with its own cuts
+        num_frames = len(real_glob(args.target_images)) if args.animation_dir is not None else 1
+        if args.best_of is not None:
+            num_frames *= args.best_of
+        num_cuts = int((budget - fixed) / (per_cut * num_frames))
+        if args.cut_batch_size is not None and num_cuts >= args.cut_batch_size:
+            # micro-batched runs only hold one batch of cuts at a time, so
+            # once a batch fits any number of cuts does
+            num_cuts = max_auto_cuts
+        if num_cuts < min_num_cuts:
+            print(f"Memory budget is too small even for {min_num_cuts} cuts (try a smaller size or fewer clip models)")
+        num_cuts = max(min_num_cuts, min(max_auto_cuts, num_cuts))
+        print(f"Memory model: {fixed / 2**30:.2f} GB fixed + {per_cut / 2**20:.1f} MB per cut, "
+              f"budget {budget / 2**30:.2f} GB -> {num_cuts} cuts")
+    torch.cuda.empty_cache()
+    set_num_cuts(num_cuts)
+    args.num_cuts = num_cuts
+
+@torch.no_grad()
+def blend_frames(args):
+    # frame i is mixed with frame i-1, either in pixel space (then all
+    # frames are re-encoded in one batch) or directly on the latents
+    alpha = args.animation_alpha / 255
+    cur_z = drawer.get_z()
+    if args.animation_blend == 'latent':
+        drawer.set_z((1 - alpha) * cur_z + alpha * cur_z.roll(1, dims=0))
+    else:
+        frames = drawer.synth(None)
+        blended = (1 - alpha) * frames + alpha * frames.roll(1, dims=0)
+        drawer.set_z(drawer.get_z_from_tensor(blended * 2 - 1))
+
+def best_of_plan(args):
+    # successive halving: [(iteration, candidates kept)], the last round
+    # leaves one. rounds are spaced geometrically so every round gets as
+    # many iterations as all the rounds before it
+    num_rounds = max(1, math.ceil(math.log(args.best_of) / math.log(1 / args.best_of_keep)))
+    plan = []
+    num_candidates = args.best_of
+    for k in range(num_rounds):
+        iteration = max(1, round(args.iterations * args.best_of_keep ** (num_rounds - k)))
+        num_candidates = 1 if k == num_rounds - 1 else max(1, math.ceil(num_candidates * args.best_of_keep))
+        plan.append((iteration, num_candidates))
+    return plan
+
+@torch.no_grad()
+def start_best_of(args):
+    # the drawer z becomes a batch with one candidate per seed, all
+    # optimized together. candidate 0 is rebuilt from run_seed too, as
+    # do_init drew its noise before an unset seed was picked
+    global z_orig
+    seeds = [run_seed + i for i in range(args.best_of)]
+    def repeat_candidates(t):
+        return t.repeat(args.best_of, *([1] * (t.dim() - 1)))
+    if args.init_image or args.init_noise:
+        orig_zs = []
+        for seed in seeds:
+            starting_image, _ = make_starting_image(args, seed, gside_X, gside_Y)
+            # same encoding as the drawer's init_from_tensor
+            orig_zs.append(drawer.get_z_from_tensor(TF.to_tensor(starting_image).to(device).unsqueeze(0)))
+        # every candidate keeps its own init for the --init_weight losses
+        z_orig = torch.cat(orig_zs)
+        candidate_z = match_z(z_orig)
+    else:
+        # same start, the candidates only differ by their cutouts
+        z_orig = repeat_candidates(z_orig)
+        candidate_z = repeat_candidates(drawer.get_z_copy())
+    drawer.replace_z(candidate_z, opts, repeat_candidates)
+    run_metadata['best_of_seeds'] = seeds
+
+@torch.no_grad()
+def score_candidates(args):
+    # clip loss of every candidate, all scored on the same cutouts
+    out = drawer.synth(cur_iteration)
+    scores = []
+    for i in range(out.shape[0]):
+        with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []):
+            torch.manual_seed(0)
+            scores.append(float(sum(clip_losses(args, out[i:i+1], args.num_cuts))))
+    return scores
+
+def prune_candidates(args, num_keep):
+    global z_orig
+    scores = score_candidates(args)
+    order = sorted(range(len(scores)), key=lambda i: scores[i])[:num_keep]
+    seeds = run_metadata['best_of_seeds']
+    scores_str = ', '.join(f'{seeds[i]}: {scores[i]:g}' for i in order)
+    tqdm.write(f'best of: keeping {num_keep} of {len(scores)} at iter {cur_iteration} ({scores_str})')
+    index = torch.tensor(order)
+    def remap(t):
+        return t.index_select(0, index.to(t.device))
+    with torch.no_grad():
+        new_z = remap(drawer.get_z())
+    drawer.replace_z(new_z, opts, remap)
+    z_orig = remap(z_orig)
+    run_metadata['best_of_seeds'] = [seeds[i] for i in order]
+
 def do_run(args):
-    global cur_iteration, cur_anim_index
-    global anim_cur_zs, anim_next_zs, anim_output_files
+    global cur_iteration, early_stopper
+    global anim_output_files, anim_z_targets, anim_writer
+
+    if result_cache_hit:
+        print(f"Using cached result: {args.output}")
+        return
 
     cur_iteration = 0
+    early_stopper = None
 
     if args.animation_dir is not None:
-        # we already have z_targets. setup some sort of global ring
-        # we need something like
-        # copies of all the current z's (they can all start off all as copies)
-        # a list of all the output filenames
-        #
+        # all frames are optimized together: the drawer z becomes a batch
+        # with one entry per target image, each pulled to its own target
         if not os.path.exists(args.animation_dir):
             os.mkdir(args.animation_dir)
         filelist = real_glob(args.target_images)
@@ -858,65 +1524,200 @@ def do_run(args):
             basename = os.path.basename(target_image)
             target_output = os.path.join(args.animation_dir, basename)
             anim_output_files.append(target_output)
-        for i in range(num_anim_frames):
-            cur_z = drawer.get_z_copy()
-            anim_cur_zs.append(cur_z)
-            anim_next_zs.append(None)
+        anim_z_targets = torch.cat(z_targets).reshape(num_anim_frames, -1)
+        anim_file = os.path.join(args.animation_dir, f"anim.{args.animation_format}")
+        anim_writer = AnimationWriter(anim_file, num_anim_frames)
 
-        step_iteration = 0
+        def repeat_frames(t):
+            return t.repeat(num_anim_frames, *([1] * (t.dim() - 1)))
+        drawer.replace_z(repeat_frames(drawer.get_z_copy()), opts, repeat_frames)
+        if args.resume:
+            cur_iteration = load_checkpoint(args)
 
-        with tqdm() as pbar:
+        with tqdm(initial=cur_iteration) as pbar:
             while True:
-                cur_images = []
-                for i in range(num_anim_frames):
-                    # do merge frames here from cur->next when we are ready to be fancy
-                    cur_anim_index = i
-                    # anim_cur_zs[cur_anim_index] = anim_next_zs[cur_anim_index]
-                    cur_iteration = step_iteration
-                    drawer.set_z(anim_cur_zs[cur_anim_index])
-                    for j in range(args.save_every):
-                        train(args, cur_iteration)
-                        cur_iteration += 1
-                        pbar.update()
-                    # anim_next_zs[cur_anim_index] = drawer.get_z_copy()
-                    cur_images.append(drawer.to_image())
-                #step_iteration = step_iteration + args.save_every
-                if step_iteration >= args.iterations/2:
-                    #drawer.full_shape()
-                    print("half there")
-                if step_iteration >= args.iterations:
+                train_step(args, cur_iteration)
+                if cur_iteration >= args.iterations:
                     break
-                # compute the next round of cur_zs here from all the next_zs
-                for i in range(num_anim_frames):
-                    prev_i = (i + num_anim_frames - 1) % num_anim_frames
-                    base_image = cur_images[i].copy()
-                    prev_image = cur_images[prev_i].copy().convert('RGBA')
-                    prev_image.putalpha(args.animation_alpha)
-                    base_image.paste(prev_image, (0, 0), prev_image)
-                    # base_image.save(f"overlaid_{i:02d}.png")
-                    drawer.reapply_from_tensor(TF.to_tensor(base_image).to(device).unsqueeze(0) * 2 - 1)
-                    anim_cur_zs[i] = drawer.get_z_copy()
+                cur_iteration += 1
+                pbar.update()
+                if cur_iteration % args.save_every == 0:
+                    # blend each frame with the previous one for consistency
+                    blend_frames(args)
+                if args.checkpoint_every and cur_iteration % args.checkpoint_every == 0:
+                    save_checkpoint(args, cur_iteration)
+        anim_writer.close()
+    elif args.zoom_frames is not None:
+        do_zoom(args)
+    elif args.style_video is not None:
+        do_style_video(args)
     else:
+        # built before resuming so load_checkpoint can restore its state
+        if args.early_stop_patience is not None:
+            early_stopper = EarlyStopper(args.early_stop_patience, args.early_stop_delta,
+                args.early_stop_min_iterations, args.early_stop_smoothing)
+        if args.resume:
+            cur_iteration = load_checkpoint(args)
+            # coarse resolution stages aren't comparable, only watch the last one
+            early_stop_start = args.resolution_schedule[-1][0] if args.resolution_schedule is not None else 0
+        if args.best_of is not None:
+            # on resume the checkpoint already holds the surviving candidates
+            if not args.resume:
+                start_best_of(args)
+            best_of_rounds = best_of_plan(args)
+        finished = False
         try:
-            with tqdm() as pbar:
+            with tqdm(initial=cur_iteration) as pbar:
                 while True:
                     try:
-                        train(args, cur_iteration)
+                        if args.resolution_schedule is not None and cur_iteration > 0:
+                            apply_resolution_stage(args, cur_iteration)
+                        losses = train_step(args, cur_iteration)
                         if cur_iteration == args.iterations:
+                            finished = True
+                            break
+                        if early_stopper is not None and cur_iteration >= early_stop_start and \
+                            early_stopper.update(cur_iteration, sum(losses).item()):
+                            tqdm.write(f'loss plateaued, stopping at iter {cur_iteration} of {args.iterations}')
+                            run_metadata['early_stop'] = {'iteration': cur_iteration, 'iterations': args.iterations,
+                                'smoothed_loss': early_stopper.smoothed_loss}
+                            checkin(args, cur_iteration, losses)
+                            finished = True
                             break
                         cur_iteration += 1
                         pbar.update()
+                        if args.best_of is not None:
+                            for round_iteration, num_keep in best_of_rounds:
+                                if cur_iteration == round_iteration and drawer.get_z().shape[0] > num_keep:
+                                    prune_candidates(args, num_keep)
+                        if args.checkpoint_every and cur_iteration % args.checkpoint_every == 0:
+                            save_checkpoint(args, cur_iteration)
                     except RuntimeError as e:
                         print("Oops: runtime error: ", e)
                         print("Try reducing --num-cuts to save memory")
                         raise e
         except KeyboardInterrupt:
             pass
+        # only finished runs are reusable
+        if args.result_cache is not None and finished:
+            store_cached_result(args)
+
+    if cut_schedule is not None and cut_schedule.total_iterations > 0:
+        fixed_cuts = cut_schedule.total_iterations * args.num_cuts
+        print(f"Cut schedule used {cut_schedule.total_cuts} cuts ({100 * cut_schedule.total_cuts / fixed_cuts:.0f}% of {args.num_cuts} every iteration)")
+        run_metadata['cut_schedule_cuts'] = cut_schedule.total_cuts
 
     if args.make_video:
         #drawer.to_svg()
         do_video(args)
 
+    timer.close()
+
+def video_output_file(args):
+    return re.compile(r'\.png$').sub('.mp4', args.output)
+
+def zoom_image(args, img):
+    # one step of the feedback loop: zoom, rotate and translate the
+    # current image (NCHW in 0-1) around its center
+    _, _, height, width = img.shape
+    angle = math.radians(args.zoom_rotate)
+    cos = math.cos(angle) / args.zoom_scale
+    sin = math.sin(angle) / args.zoom_scale
+    # affine_grid works in normalized coords, so rotation is aspect corrected
+    theta = torch.tensor([[cos, -sin * height / width, -2 * args.zoom_translate[0] / width],
+                          [sin * width / height, cos, -2 * args.zoom_translate[1] / height]],
+                         device=img.device, dtype=img.dtype).unsqueeze(0)
+    grid = F.affine_grid(theta, img.shape, align_corners=False)
+    return F.grid_sample(img, grid, padding_mode='reflection', align_corners=False)
+
+@torch.no_grad()
+def write_interpolated_frames(args, video, z_from, z_to):
+    # in between frames for two keyframes, decoded from interpolated
+    # latents in batches (instead of optical flow on the final video).
+    # the keyframes are quantized once and the blend is decoded as is,
+    # re-quantizing it would switch tokens abruptly instead of fading
+    num_frames = args.interpolate_frames
+    zq_from = drawer.quantize_z(z_from)
+    zq_to = drawer.quantize_z(z_to)
+    steps = torch.arange(1, num_frames + 1, device=z_to.device, dtype=z_to.dtype) / (num_frames + 1)
+    for start in range(0, num_frames, args.interpolate_batch):
+        t = steps[start:start + args.interpolate_batch].view(-1, 1, 1, 1)
+        frames = drawer.decode_z((1 - t) * zq_from + t * zq_to, quantize=False)
+        for frame in frames:
+            video.write(TF.to_pil_image(frame.cpu()))
+
+def keyframe_fps(args, fps):
+    # keep the keyframe timing when in between frames are added
+    return fps * (args.interpolate_frames + 1)
+
+def do_zoom(args):
+    global cur_iteration
+
+    # models and optimizer stay warm across frames: each frame gets
+    # save_every iterations, then the image is zoomed and fed back in
+    video = VideoWriter(video_output_file(args), gside_X, gside_Y, keyframe_fps(args, args.video_fps), f'{args.prompts}')
+    prev_z = None
+    try:
+        with tqdm() as pbar:
+            for frame in range(args.zoom_frames):
+                for j in range(args.save_every):
+                    train_step(args, cur_iteration)
+                    cur_iteration += 1
+                    pbar.update()
+                with torch.no_grad():
+                    if args.interpolate_frames:
+                        cur_z = drawer.get_z_copy()
+                        if prev_z is not None:
+                            write_interpolated_frames(args, video, prev_z, cur_z)
+                        prev_z = cur_z
+                    out = drawer.synth(cur_iteration)
+                    video.write(TF.to_pil_image(out[0].cpu()))
+                    drawer.reapply_from_tensor(zoom_image(args, out) * 2 - 1)
+    except KeyboardInterrupt:
+        pass
+    tqdm.write(f'Wrote {video.close()}')
+
+def do_style_video(args):
+    global cur_iteration, z_orig, init_image_tensor
+
+    # frames are decoded from an ffmpeg pipe; each one starts from its own
+    # latent blended with the previous frame's optimized latent, so after
+    # the first frame only a few iterations are needed
+    reader = VideoReader(args.style_video, gside_X, gside_Y)
+    fps = reader.fps if reader.fps is not None else args.video_fps
+    video = VideoWriter(video_output_file(args), gside_X, gside_Y, keyframe_fps(args, fps), f'{args.prompts}')
+    prev_z = None
+    try:
+        with tqdm() as pbar:
+            for frame in reader:
+                frame_tensor = TF.to_tensor(frame).to(device).unsqueeze(0)
+                with torch.no_grad():
+                    frame_z = drawer.get_z_from_tensor(frame_tensor * 2 - 1)
+                    if prev_z is None:
+                        drawer.set_z(frame_z)
+                        num_iterations = args.iterations
+                    else:
+                        blend = args.style_video_blend
+                        drawer.set_z((1 - blend) * frame_z + blend * prev_z)
+                        num_iterations = args.style_video_iterations
+                # init weights pull towards the current frame
+                z_orig = frame_z
+                init_image_tensor = frame_tensor
+                for j in range(num_iterations):
+                    train_step(args, cur_iteration)
+                    cur_iteration += 1
+                    pbar.update()
+                with torch.no_grad():
+                    cur_z = drawer.get_z_copy()
+                    if args.interpolate_frames and prev_z is not None:
+                        write_interpolated_frames(args, video, prev_z, cur_z)
+                    out = drawer.synth(cur_iteration)
+                    video.write(TF.to_pil_image(out[0].cpu()))
+                prev_z = cur_z
+    except KeyboardInterrupt:
+        pass
+    tqdm.write(f'Wrote {video.close()}')
+
 def do_video(args):
     global cur_iteration
 
@@ -942,8 +1743,7 @@ def do_video(args):
     fps = np.clip(total_frames+150/length,min_fps,max_fps)
 
     from subprocess import Popen, PIPE
-    import re
-    output_file = re.compile('\.png$').sub('.mp4', args.output)
+    output_file = video_output_file(args)
     p = Popen(['ffmpeg',
                '-y',
                '-f', 'image2pipe',
@@ -992,15 +1792,23 @@ def setup_parser():
     vq_parser.add_argument("-ezs",  "--ezsize", type=str, help="small, medium, large", default=None, dest='ezsize')
     vq_parser.add_argument("-sca",  "--scale", type=float, help="scale (instead of ezsize)", default=None, dest='scale')
     vq_parser.add_argument("-ova",  "--overlay_alpha", type=int, help="Overlay alpha (0-255)", default=None, dest='overlay_alpha')    
+    vq_parser.add_argument("-rs",   "--resolution_schedule", type=str, help="Coarse to fine scales (vqgan tokens or pixeldraw cells), eg: 1/4,1/2,1", default=None, dest='resolution_schedule')
     vq_parser.add_argument("-s",    "--size", nargs=2, type=int, help="Image size (width height)", default=None, dest='size')
     vq_parser.add_argument("-ii",   "--init_image", type=str, help="Initial image", default=None, dest='init_image')
     vq_parser.add_argument("-iia",  "--init_image_alpha", type=int, help="Init image alpha (0-255)", default=200, dest='init_image_alpha')
     vq_parser.add_argument("-in",   "--init_noise", type=str, help="Initial noise image (pixels or gradient)", default="pixels", dest='init_noise')
+    vq_parser.add_argument("-nb",   "--noise_bank", type=str, help="Directory of shared seeded init noise images", default=None, dest='noise_bank')
+    vq_parser.add_argument("-nbs",  "--noise_bank_size", type=int, help="Number of entries in the noise bank", default=16, dest='noise_bank_size')
+    vq_parser.add_argument("-lt",   "--loader_threads", type=int, help="Threads for loading and resizing images", default=None, dest='loader_threads')
+    vq_parser.add_argument("-eb",   "--encode_batch", type=int, help="Images per encoder batch for target images and labels", default=8, dest='encode_batch')
+    vq_parser.add_argument("-lc",   "--latent_cache", type=str, help="Directory for caching encoded target images and labels", default=None, dest='latent_cache')
     vq_parser.add_argument("-ti",   "--target_images", type=str, help="Target images", default=None, dest='target_images')
     vq_parser.add_argument("-tiw",  "--target_image_weight", type=float, help="Target images weight", default=1.0, dest='target_image_weight')
     vq_parser.add_argument("-twp",  "--target_weight_pix", type=float, help="Target weight pix loss", default=0., dest='target_weight_pix')
     vq_parser.add_argument("-anim", "--animation_dir", type=str, help="Animation output dir", default=None, dest='animation_dir')    
     vq_parser.add_argument("-ana",  "--animation_alpha", type=int, help="Forward blend for consistency", default=128, dest='animation_alpha')
+    vq_parser.add_argument("-anf",  "--animation_format", type=str, help="Animation preview format (gif or webp)", default='gif', dest='animation_format')
+    vq_parser.add_argument("-anb",  "--animation_blend", type=str, help="Blend frames in pixel or latent space", default='pixel', dest='animation_blend')
     vq_parser.add_argument("-iw",   "--init_weight", type=float, help="Initial weight (main=spherical)", default=None, dest='init_weight')
     vq_parser.add_argument("-iwd",  "--init_weight_dist", type=float, help="Initial weight dist loss", default=0., dest='init_weight_dist')
     vq_parser.add_argument("-iwc",  "--init_weight_cos", type=float, help="Initial weight cos loss", default=0., dest='init_weight_cos')
@@ -1013,14 +1821,43 @@ def setup_parser():
     vq_parser.add_argument("-npw",  "--noise_prompt_weights", nargs="*", type=float, help="Noise prompt weights", default=[], dest='noise_prompt_weights')
     vq_parser.add_argument("-lr",   "--learning_rate", type=float, help="Learning rate", default=0.2, dest='step_size')
     vq_parser.add_argument("-cuts", "--num_cuts", type=int, help="Number of cuts", default=None, dest='num_cuts')
+    vq_parser.add_argument("-csc",  "--cut_schedule", type=str, help="Cuts per iteration schedule (ramp, step or loss) up to num_cuts", default=None, dest='cut_schedule')
+    vq_parser.add_argument("-csm",  "--cut_schedule_min", type=int, help="Cuts at the start of the cut schedule (default num_cuts/4)", default=None, dest='cut_schedule_min')
+    vq_parser.add_argument("-cutb", "--cut_batch_size", type=int, help="Cuts per clip micro-batch (saves memory with many cuts)", default=None, dest='cut_batch_size')
+    vq_parser.add_argument("-mem",  "--memory_budget", type=str, help="GPU memory budget in GB (or auto) used to pick num_cuts", default=None, dest='memory_budget')
     vq_parser.add_argument("-cutp", "--cut_power", type=float, help="Cut power", default=1., dest='cut_pow')
     vq_parser.add_argument("-sd",   "--seed", type=int, help="Seed", default=None, dest='seed')
     vq_parser.add_argument("-opt",  "--optimiser", type=str, help="Optimiser (Adam, AdamW, Adagrad, Adamax, DiffGrad, AdamP or RAdam)", default='AdamP', dest='optimiser')
     vq_parser.add_argument("-o",    "--output", type=str, help="Output file", default="output.png", dest='output')
+    vq_parser.add_argument("-tim",  "--timings", type=bool, help="Print a per stage timing summary at the end", default=False, dest='timings')
+    vq_parser.add_argument("-tit",  "--timing_trace", type=str, help="Write per iteration stage timings (JSONL)", default=None, dest='timing_trace')
+    vq_parser.add_argument("-prof", "--profile", nargs=2, type=int, help="Torch profiler window (first iteration, number of iterations)", default=None, dest='profile')
+    vq_parser.add_argument("-prfo", "--profile_output", type=str, help="Torch profiler trace file (chrome trace)", default="profile.json", dest='profile_output')
+    vq_parser.add_argument("-esp",  "--early_stop_patience", type=int, help="Stop when the smoothed loss hasn't improved for this many iterations", default=None, dest='early_stop_patience')
+    vq_parser.add_argument("-esd",  "--early_stop_delta", type=float, help="Smallest smoothed loss decrease that counts as improvement", default=0.001, dest='early_stop_delta')
+    vq_parser.add_argument("-esm",  "--early_stop_min_iterations", type=int, help="Never stop early before this many iterations", default=50, dest='early_stop_min_iterations')
+    vq_parser.add_argument("-ess",  "--early_stop_smoothing", type=float, help="EMA factor for smoothing the loss (0-1)", default=0.9, dest='early_stop_smoothing')
+    vq_parser.add_argument("-bo",   "--best_of", type=int, help="Optimize this many seeds together and keep the best (successive halving)", default=None, dest='best_of')
+    vq_parser.add_argument("-bok",  "--best_of_keep", type=float, help="Fraction of the best of candidates kept each round", default=0.5, dest='best_of_keep')
+    vq_parser.add_argument("-rc",   "--result_cache", type=str, help="Directory for reusing results of identical runs (needs --seed)", default=None, dest='result_cache')
+    vq_parser.add_argument("-cke",  "--checkpoint_every", type=int, help="Save a resumable checkpoint every n iterations", default=None, dest='checkpoint_every')
+    vq_parser.add_argument("-ckf",  "--checkpoint_file", type=str, help="Checkpoint file (default: output with .ckpt)", default=None, dest='checkpoint_file')
+    vq_parser.add_argument("-res",  "--resume", type=bool, help="Resume from the checkpoint file", default=False, dest='resume')
+    vq_parser.add_argument("-zoom", "--zoom_frames", type=int, help="Zoom video mode: number of frames (save_every iterations each)", default=None, dest='zoom_frames')
+    vq_parser.add_argument("-zsc",  "--zoom_scale", type=float, help="Zoom factor per frame", default=1.01, dest='zoom_scale')
+    vq_parser.add_argument("-zrt",  "--zoom_rotate", type=float, help="Rotation per frame (degrees)", default=0., dest='zoom_rotate')
+    vq_parser.add_argument("-ztr",  "--zoom_translate", nargs=2, type=float, help="Translation per frame (x y pixels)", default=[0., 0.], dest='zoom_translate')
+    vq_parser.add_argument("-sv",   "--style_video", type=str, help="Style video mode: input video", default=None, dest='style_video')
+    vq_parser.add_argument("-svb",  "--style_video_blend", type=float, help="Blend of the previous frame latent (0-1)", default=0.5, dest='style_video_blend')
+    vq_parser.add_argument("-svi",  "--style_video_iterations", type=int, help="Iterations per frame after the first", default=25, dest='style_video_iterations')
+    vq_parser.add_argument("-ipf",  "--interpolate_frames", type=int, help="Latent in between frames per video keyframe", default=0, dest='interpolate_frames')
+    vq_parser.add_argument("-ipb",  "--interpolate_batch", type=int, help="Batch size for decoding in between frames", default=8, dest='interpolate_batch')
+    vq_parser.add_argument("-vfps", "--video_fps", type=int, help="Frame rate for zoom videos (and style videos without one)", default=30, dest='video_fps')
     vq_parser.add_argument("-vid",  "--video", type=bool, help="Create video frames?", default=False, dest='make_video')
     vq_parser.add_argument("-d",    "--deterministic", type=bool, help="Enable cudnn.deterministic?", default=False, dest='cudnn_determinism')
     vq_parser.add_argument("-cd",   "--use_clipdraw", type=bool, help="Use clipdraw", default=False, dest='use_clipdraw')
     vq_parser.add_argument("-st",   "--strokes", type=int, help="clipdraw strokes", default=1024, dest='strokes')
+    vq_parser.add_argument("-cdr",  "--clipdraw_renderer", type=str, help="clipdraw renderer (diffvg or soft)", default='diffvg', dest='clipdraw_renderer')
     vq_parser.add_argument("-pd",   "--use_pixeldraw", type=bool, help="Use pixeldraw", default=False, dest='use_pixeldraw')
     vq_parser.add_argument("-mo",   "--do_mono", type=bool, help="Monochromatic", default=False, dest='do_mono')
 
@@ -1033,8 +1870,8 @@ twitter2_size = [750, 250]  # at the small size this becomes 192,112
 
 def process_args(vq_parser, namespace=None):
     global global_aspect_width
-    global cur_iteration, cur_anim_index, anim_output_files, anim_cur_zs, anim_next_zs;
-    global global_spot_file
+    global cur_iteration, anim_output_files, anim_z_targets, anim_writer
+    global global_spot_file, result_cache_hit, run_metadata, cut_schedule
 
     if namespace == None:
       # command line: use ARGV to get args
@@ -1064,8 +1901,7 @@ def process_args(vq_parser, namespace=None):
         'better': 3,
         'best': 4
     }
-    # this should be replaced with logic that does somethings
-    # smart based on available memory (eg: size, num_models, etc)
+    # --memory_budget replaces these with the most cuts that fit
     quality_to_num_cuts_table = {
         'draft': 40,
         'normal': 40,
@@ -1081,6 +1917,16 @@ def process_args(vq_parser, namespace=None):
         args.clip_models = quality_to_clip_models_table[args.quality]
     if args.iterations is None:
         args.iterations = quality_to_iterations_table[args.quality]
+    if args.memory_budget is not None and args.num_cuts is not None:
+        print("num_cuts is set, ignoring memory budget")
+        args.memory_budget = None
+    if args.memory_budget is not None and args.memory_budget != 'auto':
+        try:
+            float(args.memory_budget)
+        except ValueError:
+            print("memory budget not understood, aborting -> ", args.memory_budget)
+            exit(1)
+    # with a memory budget this is only the starting point for auto tuning
     if args.num_cuts is None:
         args.num_cuts = quality_to_num_cuts_table[args.quality]
     if args.ezsize is None and args.scale is None:
@@ -1123,6 +1969,31 @@ def process_args(vq_parser, namespace=None):
     else:
         global_aspect_width = 1
 
+    if args.clipdraw_renderer not in ('diffvg', 'soft'):
+        print("clipdraw renderer not understood, aborting -> ", args.clipdraw_renderer)
+        exit(1)
+
+    if args.style_video is not None and (args.use_clipdraw or args.use_pixeldraw):
+        print("style video needs the vqgan drawer, aborting")
+        exit(1)
+
+    if args.zoom_frames is not None and args.use_clipdraw:
+        # clipdraw strokes can't be reset from a zoomed image
+        print("zoom video needs the vqgan or pixeldraw drawer, aborting")
+        exit(1)
+
+    if args.interpolate_frames and (args.use_clipdraw or args.use_pixeldraw):
+        print("interpolated frames need the vqgan drawer, ignoring")
+        args.interpolate_frames = 0
+
+    if args.animation_format not in ('gif', 'webp'):
+        print("animation format not understood, aborting -> ", args.animation_format)
+        exit(1)
+
+    if args.animation_blend not in ('pixel', 'latent'):
+        print("animation blend not understood, aborting -> ", args.animation_blend)
+        exit(1)
+
     if args.init_noise.lower() == "none":
         args.init_noise = None
 
@@ -1153,9 +2024,70 @@ def process_args(vq_parser, namespace=None):
     #     args.init_weight_cos = args.init_weight
     #     args.init_weight_dist = args.init_weight
 
+    # Split the resolution schedule into evenly spaced stages
+    if args.resolution_schedule is not None:
+        if args.use_clipdraw or args.animation_dir is not None or \
+            args.zoom_frames is not None or args.style_video is not None:
+            print("resolution schedule is only used for single vqgan or pixeldraw runs, ignoring")
+            args.resolution_schedule = None
+        else:
+            scales = [float(Fraction(scale.strip())) for scale in args.resolution_schedule.split(",")]
+            if scales[-1] != 1:
+                scales.append(1)
+            args.resolution_schedule = [(args.iterations * i // len(scales), scale)
+                                        for i, scale in enumerate(scales)]
+
     if args.overlay_every is not None and args.overlay_every <= 0:
         args.overlay_every = None
 
+    if args.early_stop_patience is not None and (args.animation_dir is not None or \
+        args.zoom_frames is not None or args.style_video is not None):
+        print("early stopping is only used for single image runs, ignoring")
+        args.early_stop_patience = None
+
+    if args.best_of is not None:
+        if args.best_of <= 1:
+            args.best_of = None
+        elif args.use_clipdraw or args.use_pixeldraw:
+            print("best of needs the vqgan drawer, aborting")
+            exit(1)
+        elif args.animation_dir is not None or args.zoom_frames is not None or args.style_video is not None:
+            print("best of is only used for single image runs, ignoring")
+            args.best_of = None
+        elif not 0 < args.best_of_keep < 1:
+            print("best of keep fraction must be between 0 and 1, aborting -> ", args.best_of_keep)
+            exit(1)
+        elif args.early_stop_patience is not None:
+            print("early stopping is not used with best of, ignoring")
+            args.early_stop_patience = None
+
+    if args.cut_schedule is not None and args.cut_schedule not in ('ramp', 'step', 'loss'):
+        print("cut schedule not understood, aborting -> ", args.cut_schedule)
+        exit(1)
+
+    if args.cut_batch_size is not None and args.cut_batch_size <= 0:
+        args.cut_batch_size = None
+
+    if args.result_cache is not None:
+        if args.seed is None:
+            print("result cache needs an explicit --seed, ignoring")
+            args.result_cache = None
+        elif args.animation_dir is not None or args.zoom_frames is not None or \
+            args.style_video is not None or args.make_video:
+            print("result cache is only used for single image runs, ignoring")
+            args.result_cache = None
+
+    if args.checkpoint_file is None:
+        args.checkpoint_file = os.path.splitext(args.output)[0] + '.ckpt'
+    if args.zoom_frames is not None or args.style_video is not None:
+        if args.checkpoint_every or args.resume:
+            print("checkpoints are not supported for video modes, ignoring")
+        args.checkpoint_every = None
+        args.resume = False
+    elif args.resume and not os.path.exists(args.checkpoint_file):
+        print(f"No checkpoint to resume from: {args.checkpoint_file}")
+        sys.exit(1)
+
     clip_models = args.clip_models.split(",")
     args.clip_models = [model.strip() for model in clip_models]
 
@@ -1166,10 +2098,12 @@ def process_args(vq_parser, namespace=None):
 
     # reset global animation variables
     cur_iteration=None
-    cur_anim_index=None
     anim_output_files=[]
-    anim_cur_zs=[]
-    anim_next_zs=[]
+    anim_z_targets=None
+    anim_writer=None
+    result_cache_hit=False
+    run_metadata={}
+    cut_schedule=None
 
     global_spot_file = args.spot_file
 
@@ -1,7 +1,8 @@
-from DrawingInterface import DrawingInterface
+from DrawingInterface import DrawingInterface, migrate_optimizer_state
 
 import pydiffvg
 import torch
+from torch.nn import functional as F
 import skimage
 import skimage.io
 import random
@@ -21,9 +22,7 @@ class PixelDrawer(DrawingInterface):
     num_cols = 45*3
     end_num_rows = 80
     end_num_cols = 80*3
-    color_vars = []
     do_mono = False
-    pixels = []
 
     def __init__(self, width, height, do_mono, shape=None):
         super(DrawingInterface, self).__init__()
@@ -36,11 +35,6 @@ class PixelDrawer(DrawingInterface):
         if shape is not None:
             self.end_num_rows, self.end_num_cols = shape
 
-    def set_shapes(self, shape=None):
-        print("setting shape", shape)
-        if shape is not None:
-            self.num_rows, self.num_cols = shape
-            
     def load_model(self, config_path, checkpoint_path, device):
         # gamma = 1.0
 
@@ -49,98 +43,61 @@ class PixelDrawer(DrawingInterface):
         device = torch.device('cuda')
         pydiffvg.set_device(device)
 
-        canvas_width, canvas_height = self.canvas_width, self.canvas_height
         num_rows, num_cols = self.end_num_rows, self.end_num_cols
-        cell_width = canvas_width / num_cols
-        cell_height = canvas_height / num_rows
 
         # Initialize Random Pixels
-        shapes = []
-        shape_groups = []
-        colors = []
-        for r in range(num_rows):
-            cur_y = r * cell_height
-            for c in range(num_cols):
-                cur_x = c * cell_width
-                if self.do_mono:
-                    mono_color = random.random()
-                    cell_color = torch.tensor([mono_color, mono_color, mono_color, 1.0])
-                else:
-                    cell_color = torch.tensor([random.random(), random.random(), random.random(), 1.0])
-                colors.append(cell_color)
-                p0 = [cur_x, cur_y]
-                p1 = [cur_x+cell_width, cur_y+cell_height]
-                path = pydiffvg.Rect(p_min=torch.tensor(p0), p_max=torch.tensor(p1))
-                shapes.append(path)
-                path_group = pydiffvg.ShapeGroup(shape_ids = torch.tensor([len(shapes) - 1]), stroke_color = None, fill_color = cell_color)
-                shape_groups.append(path_group)
-
-        # Just some diffvg setup
-        scene_args = pydiffvg.RenderFunction.serialize_scene(\
-            canvas_width, canvas_height, shapes, shape_groups)
-        render = pydiffvg.RenderFunction.apply
-        img = render(canvas_width, canvas_height, 2, 2, 0, None, *scene_args)
+        self.build_grid(num_rows, num_cols, self.random_colors(num_rows, num_cols))
+        self.make_opts()
 
-        for group in shape_groups:
-            group.fill_color.requires_grad = True
-            self.color_vars.append(group.fill_color)
-
-        # Optimizers
-        # points_optim = torch.optim.Adam(points_vars, lr=1.0)
-        # width_optim = torch.optim.Adam(stroke_width_vars, lr=0.1)
-        color_optim = torch.optim.Adam(self.color_vars, lr=0.02)
-
-        self.img = img
-        self.shapes = shapes 
-        self.shape_groups  = shape_groups
-        self.opts = [color_optim]
-        
         self.synth(0)
-        
+
         pimg = self.to_image()
         pimg.save("start.png")
-        
+
     def get_opts(self):
         return self.opts
 
-    def rand_init(self, toksX, toksY):
-        # TODO
-        pass
-
-    def init_from_tensor(self, init_tensor):
-        print("init tensor")
+    def random_colors(self, num_rows, num_cols):
+        # one rgba row per cell, in row major order
+        num_cells = num_rows * num_cols
+        if self.do_mono:
+            rgb = torch.rand(num_cells, 1).expand(-1, 3)
+        else:
+            rgb = torch.rand(num_cells, 3)
+        return torch.cat([rgb, torch.ones(num_cells, 1)], dim=1)
+
+    def colors_from_tensor(self, init_tensor, num_rows, num_cols):
+        # area average the image over each cell in one pass
+        # (adaptive pooling handles cells that do not align to pixels)
+        cells = F.adaptive_avg_pool2d(init_tensor[:, :3].float(), (num_rows, num_cols))
+        rgb = cells[0].detach().permute(1, 2, 0).reshape(-1, 3).cpu()
+        if self.do_mono:
+            rgb = rgb.mean(dim=1, keepdim=True).expand(-1, 3)
+        return torch.cat([rgb, torch.ones(rgb.shape[0], 1)], dim=1)
+
+    def build_grid(self, num_rows, num_cols, colors):
         canvas_width, canvas_height = self.canvas_width, self.canvas_height
-        num_rows, num_cols = self.end_num_rows, self.end_num_cols
-        
         cell_width = canvas_width / num_cols
         cell_height = canvas_height / num_rows
 
-        # Initialize Random Pixels
+        # all cell colors live in one packed tensor, each shape group
+        # gets a view of its row so the optimizer sees a single parameter
+        self.colors = colors.contiguous().requires_grad_(True)
+        self.color_vars = [self.colors]
+
+        ys = torch.arange(num_rows, dtype=torch.float32) * cell_height
+        xs = torch.arange(num_cols, dtype=torch.float32) * cell_width
+        grid_y, grid_x = torch.meshgrid(ys, xs)
+        p_mins = torch.stack([grid_x.reshape(-1), grid_y.reshape(-1)], dim=1)
+        p_maxs = p_mins + torch.tensor([cell_width, cell_height])
+
         shapes = []
         shape_groups = []
-        colors = []
-        for r in range(num_rows):
-            cur_y = r * cell_height
-            for c in range(num_cols):
-                cur_x = c * cell_width
-                if self.do_mono:
-                    mono_color = random.random()
-                    cell_color = torch.tensor([mono_color, mono_color, mono_color, 1.0])
-                else:
-                    try:
-                        cell_color = torch.tensor([init_tensor[0][0][int(cur_y)][int(cur_x)], init_tensor[0][1][int(cur_y)][int(cur_x)], init_tensor[0][2][int(cur_y)][int(cur_x)], 1])
-                    except BaseException as error:
-                        mono_color = random.random()
-                        cell_color = torch.tensor([mono_color, mono_color, mono_color, 1.0])
-                cell_color.requires_grad = True
-                self.color_vars.append(cell_color)
-                colors.append(cell_color)
-                p0 = [cur_x, cur_y]
-                p1 = [cur_x+cell_width, cur_y+cell_height]
-                path = pydiffvg.Rect(p_min=torch.tensor(p0), p_max=torch.tensor(p1))
-                shapes.append(path)
-                path_group = pydiffvg.ShapeGroup(shape_ids = torch.tensor([len(shapes) - 1]), stroke_color = None, fill_color = cell_color)
-                shape_groups.append(path_group)
+        for i in range(num_rows * num_cols):
+            path = pydiffvg.Rect(p_min=p_mins[i], p_max=p_maxs[i])
+            shapes.append(path)
+            path_group = pydiffvg.ShapeGroup(shape_ids = torch.tensor([i]), stroke_color = None, fill_color = self.colors[i])
+            shape_groups.append(path_group)
 
         # Just some diffvg setup
         scene_args = pydiffvg.RenderFunction.serialize_scene(\
@@ -148,115 +105,57 @@ class PixelDrawer(DrawingInterface):
         render = pydiffvg.RenderFunction.apply
         img = render(canvas_width, canvas_height, 2, 2, 0, None, *scene_args)
 
+        self.num_rows, self.num_cols = num_rows, num_cols
+        self.img = img
+        self.shapes = shapes
+        self.shape_groups  = shape_groups
+
+    def make_opts(self):
         # Optimizers
         # points_optim = torch.optim.Adam(points_vars, lr=1.0)
         # width_optim = torch.optim.Adam(stroke_width_vars, lr=0.1)
         color_optim = torch.optim.Adam(self.color_vars, lr=0.02)
-        print("self.color_vars", self.color_vars)
-        self.img = img
-        self.shapes = shapes
-        self.shape_groups  = shape_groups
         self.opts = [color_optim]
 
-        print("from_image_shape", img.shape)
+    def rand_init(self, toksX, toksY):
+        self.build_grid(self.end_num_rows, self.end_num_cols,
+            self.random_colors(self.end_num_rows, self.end_num_cols))
+        self.make_opts()
 
-        #self.synth(0)
-        #pimg = self.to_image()
-        #pimg.save("init.png")
-        #self.half_shape()
-        print("self.color_vars_half", self.color_vars)
+    def init_from_tensor(self, init_tensor):
+        num_rows, num_cols = self.end_num_rows, self.end_num_cols
+        self.build_grid(num_rows, num_cols,
+            self.colors_from_tensor(init_tensor, num_rows, num_cols))
+        self.make_opts()
+
+    def resize_grid(self, num_rows, num_cols):
+        # progressive resolution: every new cell starts from the color of
+        # the old cell it falls in (so splitting a cell copies the parent)
+        # and the optimizer keeps going with its state remapped the same way
+        rows = torch.arange(num_rows) * self.num_rows // num_rows
+        cols = torch.arange(num_cols) * self.num_cols // num_cols
+        index = (rows[:, None] * self.num_cols + cols[None, :]).reshape(-1)
+        def remap(t):
+            return t[index.to(t.device)]
+        old_colors = self.colors
+        self.build_grid(num_rows, num_cols, remap(old_colors.detach()))
+        migrate_optimizer_state(self.opts, old_colors, self.colors, remap)
 
-        
     def reapply_from_tensor(self, new_tensor):
-        # TODO
-        pass
+        # new_tensor is in -1..1 (same as the vqgan drawer)
+        colors = self.colors_from_tensor((new_tensor + 1) / 2, self.num_rows, self.num_cols)
+        with torch.no_grad():
+            self.colors.copy_(colors)
     
-    def half_shape(self):
-        print("half_shape")
-        self.set_shapes((int(self.end_num_rows/2), int(self.end_num_cols/2)))
-        
-        canvas_width, canvas_height = self.canvas_width, self.canvas_height
-        num_rows, num_cols = self.num_rows, self.num_cols
-
-        cell_width = canvas_width / num_cols
-        cell_height = canvas_height / num_rows
-
-        # Initialize Random Pixels
-        shapes = []
-        shape_groups = []
-        colors = []
-        i = 0
-        for r in range(self.num_rows):
-            cur_y = r * cell_height
-            for c in range(self.num_cols):
-                cur_x = c * cell_width
-                p0 = [cur_x, cur_y]
-                p1 = [cur_x+cell_width, cur_y+cell_height]
-                path = pydiffvg.Rect(p_min=torch.tensor(p0), p_max=torch.tensor(p1))
-                shapes.append(path)
-                self.color_vars[i].requires_grad = True
-                path_group = pydiffvg.ShapeGroup(shape_ids = torch.tensor([len(shapes) - 1]), stroke_color = None, fill_color = self.color_vars[i])
-                shape_groups.append(path_group)
-                i = i+2
-            i = i+2
-
-        # Just some diffvg setup
-        scene_args = pydiffvg.RenderFunction.serialize_scene(\
-            canvas_width, canvas_height, shapes, shape_groups)
-        render = pydiffvg.RenderFunction.apply
-        img = render(canvas_width, canvas_height, 2, 2, 0, None, *scene_args)
-
-        print("self.color_vars", self.color_vars[0])
-        
-        self.img = img
-        self.shapes = shapes 
-        self.shape_groups  = shape_groups
-        #self.synth(0)
-        print("from_image_shape", img.shape)
+    def get_state(self):
+        return {'num_rows': self.num_rows, 'num_cols': self.num_cols, 'colors': self.colors.detach().cpu()}
 
-        #pimg = self.to_image()
-        #pimg.save("scale.png")
-
-    def full_shape(self):
-        print("full_shape")
-        canvas_width, canvas_height = self.canvas_width, self.canvas_height
-        num_rows, num_cols = self.end_num_rows, self.end_num_cols
-
-        cell_width = canvas_width / num_cols
-        cell_height = canvas_height / num_rows
-
-        # Initialize Random Pixels
-        shapes = []
-        shape_groups = []
-        colors = []
-        i = 0
-        for r in range(num_rows):
-            cur_y = r * cell_height
-            for c in range(num_cols):
-                cur_x = c * cell_width
-                p0 = [cur_x, cur_y]
-                p1 = [cur_x+cell_width, cur_y+cell_height]
-                path = pydiffvg.Rect(p_min=torch.tensor(p0), p_max=torch.tensor(p1))
-                shapes.append(path)
-                self.color_vars[i].requires_grad = True
-                path_group = pydiffvg.ShapeGroup(shape_ids = torch.tensor([len(shapes) - 1]), stroke_color = None, fill_color = self.color_vars[i])
-                shape_groups.append(path_group)
-
-        # Just some diffvg setup
-        scene_args = pydiffvg.RenderFunction.serialize_scene(\
-            canvas_width, canvas_height, shapes, shape_groups)
-        render = pydiffvg.RenderFunction.apply
-        img = render(canvas_width, canvas_height, 2, 2, 0, None, *scene_args)
-
-        self.img = img
-        self.shapes = shapes 
-        self.shape_groups  = shape_groups
-
-        print("from_image_shape", img.shape)
-
-        #self.synth(0)
-        #pimg = self.to_image()
-        #pimg.save("scale2.png")
+    def set_state(self, state, opts=None):
+        # the grid can be at another size when saved during a resolution schedule
+        if (state['num_rows'], state['num_cols']) != (self.num_rows, self.num_cols):
+            self.resize_grid(state['num_rows'], state['num_cols'])
+        with torch.no_grad():
+            self.colors.copy_(state['colors'])
 
     def get_z_from_tensor(self, ref_tensor):
         return None
@@ -295,16 +194,12 @@ class PixelDrawer(DrawingInterface):
         return pimg
 
     def clip_z(self):
-        print("self.color_varsz1", self.color_vars[0])
         with torch.no_grad():
-            for group in self.shape_groups:
-                group.fill_color.data[:3].clamp_(0.0, 1.0)
-                group.fill_color.data[3].clamp_(1.0, 1.0)
-                if self.do_mono:
-                    avg_amount = torch.mean(group.fill_color.data[:3])
-                    group.fill_color.data[:3] = avg_amount
-        print("self.color_varsz2", self.color_vars[0])
-                
+            self.colors[:, :3].clamp_(0.0, 1.0)
+            self.colors[:, 3].fill_(1.0)
+            if self.do_mono:
+                avg_amount = self.colors[:, :3].mean(dim=1, keepdim=True)
+                self.colors[:, :3] = avg_amount
 
     def get_z(self):
         return None
@@ -0,0 +1,108 @@
+# On disk cache of finished runs keyed by a hash of everything that
+# determines the result: the resolved settings, the input and model
+# files and the code itself. A re-submitted identical job (with an
+# explicit seed) then just copies the stored outputs.
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+
+def file_identity(path):
+    # files are identified by size and mtime so large inputs (eg: videos
+    # or model checkpoints) don't need to be read. urls only by name.
+    if path is None:
+        return None
+    if not os.path.exists(path):
+        return path
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+def code_identity(code_files):
+    digest = hashlib.sha1()
+    for path in code_files:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def settings_key(settings, files=(), code_files=()):
+    # canonical json, so key order and tuple vs list don't matter
+    identity = {
+        'settings': settings,
+        'files': [file_identity(path) for path in files],
+        'code': code_identity(code_files),
+    }
+    blob = json.dumps(identity, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+class ResultCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.stats_file = os.path.join(cache_dir, 'stats.json')
+        self.lock_file = os.path.join(cache_dir, 'stats.lock')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def lookup(self, key):
+        # returns the metadata of a stored result (or None) and counts the hit or miss
+        metadata_file = os.path.join(self.entry_dir(key), 'metadata.json')
+        metadata = None
+        if os.path.exists(metadata_file):
+            with open(metadata_file) as f:
+                metadata = json.load(f)
+        self.count('hits' if metadata is not None else 'misses')
+        return metadata
+
+    def fetch(self, key, name, dest):
+        # copy a stored file out of the cache, False if it wasn't stored
+        src = os.path.join(self.entry_dir(key), name)
+        if not os.path.exists(src):
+            return False
+        shutil.copyfile(src, dest)
+        return True
+
+    def store(self, key, files, metadata):
+        # files maps the stored name to the file to copy. the entry is
+        # assembled next to its final place and renamed in, so lookups
+        # never see a partial entry
+        entry_dir = self.entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+        tmp_dir = f'{entry_dir}.{os.getpid()}.tmp'
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name, path in files.items():
+            if path is not None and os.path.exists(path):
+                shutil.copyfile(path, os.path.join(tmp_dir, name))
+        metadata = dict(metadata, key=key, created=time.time())
+        with open(os.path.join(tmp_dir, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f, sort_keys=True, indent=1, default=str)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another run stored the same result first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def stats(self):
+        if not os.path.exists(self.stats_file):
+            return {'hits': 0, 'misses': 0}
+        with open(self.stats_file) as f:
+            return json.load(f)
+
+    def count(self, field):
+        # concurrent runs share the stats, so the read-modify-write is
+        # serialized with a lock file (the temp file only stops torn writes)
+        with open(self.lock_file, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                stats = self.stats()
+                stats[field] = stats.get(field, 0) + 1
+                tmp_file = f'{self.stats_file}.{os.getpid()}.tmp'
+                with open(tmp_file, 'w') as f:
+                    json.dump(stats, f)
+                os.replace(tmp_file, self.stats_file)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,202 @@
+# Soft rasterizer for the cubic bezier strokes used by ClipDrawer.
+# This is an alternative to pydiffvg that only needs torch, so it
+# also runs on cpu and can render a batch of canvases in one call.
+#
+# Each curve is flattened into a polyline, every pixel takes its distance
+# to the nearest segment of a stroke and coverage is a sigmoid of that
+# distance against the stroke width. The canvas is split into tiles and
+# each tile only looks at the strokes whose bounding box overlaps it.
+
+import argparse
+import time
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+def curve_index_table(path_sizes):
+    # maps the packed ClipDrawer points (one run of 1+3*segments points
+    # per path) to a [num_paths, max_curves, 4] table of control points.
+    # paths with fewer curves repeat their last curve, which leaves the
+    # distance to the stroke unchanged so no mask is needed.
+    max_curves = max((n - 1) // 3 for n in path_sizes)
+    index = torch.zeros(len(path_sizes), max_curves, 4, dtype=torch.long)
+    offset = 0
+    for i, n in enumerate(path_sizes):
+        num_curves = (n - 1) // 3
+        for k in range(max_curves):
+            start = offset + 3 * min(k, num_curves - 1)
+            index[i, k] = torch.arange(start, start + 4)
+        offset += n
+    return index
+
+def sample_curves(control_points, samples):
+    # control_points: [B, N, M, 4, 2] -> polyline segments [B, N, M*samples, 2, 2]
+    t = torch.linspace(0, 1, samples + 1, device=control_points.device, dtype=control_points.dtype)
+    mt = 1 - t
+    basis = torch.stack([mt**3, 3 * mt**2 * t, 3 * mt * t**2, t**3], dim=1)
+    pts = torch.einsum('sj,bnmjd->bnmsd', basis, control_points)
+    segs = torch.stack([pts[:, :, :, :-1], pts[:, :, :, 1:]], dim=-2)
+    B, N, M, S = segs.shape[:4]
+    return segs.reshape(B, N, M * S, 2, 2)
+
+def render_tiles(segs, stroke_widths, stroke_colors, ids, ok, pixels, background, softness):
+    # colors of the pixels of a block of T tiles -> [B, T, 3, P]
+    seg = segs[:, ids]                                                      # [B, T, K, S, 2, 2]
+    a = seg[..., 0, :]
+    ab = seg[..., 1, :] - a
+    ap = pixels[None, :, None, None, :, :] - a[..., None, :]                 # [B, T, K, S, P, 2]
+    denom = (ab * ab).sum(-1).clamp(min=1e-8)
+    h = ((ap * ab[..., None, :]).sum(-1) / denom[..., None]).clamp(0, 1)
+    closest = ap - h[..., None] * ab[..., None, :]
+    dist = (closest.pow(2).sum(-1) + 1e-8).sqrt().amin(dim=3)               # [B, T, K, P]
+
+    w = stroke_widths[:, ids]                                               # [B, T, K]
+    col = stroke_colors[:, ids]                                             # [B, T, K, 4]
+    cover = torch.sigmoid((w[..., None] - dist) / softness)
+    alpha = cover * col[..., 3:4] * ok[None, :, :, None]
+
+    # painter's order: stroke k is seen through all strokes drawn after it
+    keep = torch.cumprod((1 - alpha).flip(2), dim=2).flip(2)
+    through = torch.cat([keep[:, :, 1:], torch.ones_like(keep[:, :, :1])], dim=2)
+    rgb = torch.einsum('btkp,btkc->btcp', alpha * through, col[..., :3])
+    return rgb + background * keep[:, :, 0, None, :]
+
+def render(control_points, stroke_widths, stroke_colors, width, height,
+           background=1.0, tile_size=16, samples=8, softness=0.5, max_elements=2**24):
+    """
+    control_points: [B, N, M, 4, 2] in pixel coordinates
+    stroke_widths: [B, N], distance from the curve to the stroke edge (as in pydiffvg)
+    stroke_colors: [B, N, 4] rgba, later strokes are drawn on top
+    returns an image batch [B, 3, height, width] in NCHW
+    """
+    device = control_points.device
+    dtype = control_points.dtype
+    segs = sample_curves(control_points, samples)
+    B, N, S = segs.shape[:3]
+
+    # bounding box of every stroke (shared across the batch)
+    reach = stroke_widths.detach().amax(dim=0) + 4 * softness
+    flat = segs.detach().reshape(B, N, -1, 2)
+    lo = flat.amin(dim=(0, 2)) - reach[:, None]
+    hi = flat.amax(dim=(0, 2)) + reach[:, None]
+
+    # tile binning: which strokes can touch which tile
+    tiles_x = (width + tile_size - 1) // tile_size
+    tiles_y = (height + tile_size - 1) // tile_size
+    ty, tx = torch.meshgrid(torch.arange(tiles_y, device=device), torch.arange(tiles_x, device=device))
+    tile_lo = torch.stack([tx.reshape(-1), ty.reshape(-1)], dim=1).to(dtype) * tile_size
+    tile_hi = tile_lo + tile_size
+    overlap = (tile_lo[:, None, :] <= hi[None]).all(dim=-1) & (tile_hi[:, None, :] >= lo[None]).all(dim=-1)
+    num_tiles = overlap.shape[0]
+    K = max(int(overlap.sum(dim=1).max().item()), 1)
+
+    # per tile stroke lists in drawing order, padded with index N
+    order = torch.arange(N, device=device).expand(num_tiles, N)
+    order = torch.where(overlap, order, torch.full_like(order, N))
+    stroke_ids = order.sort(dim=1).values[:, :K]
+    valid = stroke_ids < N
+    stroke_ids = stroke_ids.clamp(max=N - 1)
+
+    # pixel centers inside a tile
+    py, px = torch.meshgrid(torch.arange(tile_size, device=device), torch.arange(tile_size, device=device))
+    local = torch.stack([px.reshape(-1), py.reshape(-1)], dim=1).to(dtype) + 0.5
+    P = local.shape[0]
+
+    # each block of tiles is checkpointed: backward recomputes its
+    # [B, T, K, S, P, 2] temporaries instead of keeping them for every
+    # block, so memory stays bounded by max_elements in both directions
+    needs_grad = torch.is_grad_enabled() and any(t.requires_grad for t in (segs, stroke_widths, stroke_colors))
+    chunk = max(1, max_elements // (B * K * S * P))
+    blocks = []
+    for start in range(0, num_tiles, chunk):
+        ids = stroke_ids[start:start + chunk]
+        ok = valid[start:start + chunk]
+        pixels = tile_lo[start:start + chunk, None, :] + local[None]           # [T, P, 2]
+        if needs_grad:
+            # reentrant checkpointing (the only kind in torch 1.9) is fine
+            # here, segs or the stroke params always require grad
+            rgb = checkpoint(render_tiles, segs, stroke_widths, stroke_colors, ids, ok, pixels,
+                             background, softness)
+        else:
+            rgb = render_tiles(segs, stroke_widths, stroke_colors, ids, ok, pixels, background, softness)
+        blocks.append(rgb)
+
+    tiles = torch.cat(blocks, dim=1).reshape(B, tiles_y, tiles_x, 3, tile_size, tile_size)
+    img = tiles.permute(0, 3, 1, 4, 2, 5).reshape(B, 3, tiles_y * tile_size, tiles_x * tile_size)
+    return img[:, :, :height, :width]
+
+def random_strokes(num_paths, width, height, batch=1, device=None):
+    # same distribution as ClipDrawer's random init, already in padded form
+    path_sizes = [1 + 3 * int(n) for n in torch.randint(1, 4, (num_paths,))]
+    points = []
+    for n in path_sizes:
+        steps = (torch.rand(n, 2) - 0.5) * 0.1
+        steps[0] = torch.rand(2)
+        points.append(steps.cumsum(dim=0))
+    points = torch.cat(points) * torch.tensor([width, height])
+    index = curve_index_table(path_sizes)
+    control = points[index].unsqueeze(0).repeat(batch, 1, 1, 1, 1).to(device)
+    widths = torch.full((batch, num_paths), height / 100, device=device)
+    colors = torch.rand(batch, num_paths, 4, device=device)
+    return points, path_sizes, control, widths, colors
+
+def benchmark(args):
+    device = torch.device(args.device)
+    width, height = args.size
+    points, path_sizes, control, widths, colors = random_strokes(args.strokes, width, height, args.batch, device)
+    control.requires_grad_(True)
+
+    def time_it(name, step):
+        step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = (time.perf_counter() - start) / args.iterations
+        print(f"{name:>8}: {elapsed*1000:8.1f} ms per forward+backward (batch {args.batch})")
+
+    def soft_step():
+        img = render(control, widths, colors, width, height, tile_size=args.tile_size)
+        img.mean().backward()
+
+    time_it('soft', soft_step)
+
+    try:
+        import pydiffvg
+    except ImportError:
+        print("  diffvg: pydiffvg not installed, skipping")
+        return
+    pydiffvg.set_print_timing(False)
+    pydiffvg.set_use_gpu(device.type == 'cuda')
+    pydiffvg.set_device(device)
+    diff_points = points.clone().requires_grad_(True)
+    shapes, groups = [], []
+    offset = 0
+    for i, n in enumerate(path_sizes):
+        num_control_points = torch.zeros((n - 1) // 3, dtype = torch.int32) + 2
+        shapes.append(pydiffvg.Path(num_control_points = num_control_points, points = diff_points[offset:offset+n],
+            stroke_width = widths[0, i].cpu(), is_closed = False))
+        groups.append(pydiffvg.ShapeGroup(shape_ids = torch.tensor([i]), fill_color = None, stroke_color = colors[0, i].cpu()))
+        offset += n
+
+    def diffvg_step():
+        # diffvg has no batch dimension, so one scene per canvas
+        for b in range(args.batch):
+            scene_args = pydiffvg.RenderFunction.serialize_scene(width, height, shapes, groups)
+            img = pydiffvg.RenderFunction.apply(width, height, 2, 2, 0, None, *scene_args)
+            img.mean().backward()
+
+    time_it('diffvg', diffvg_step)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the soft stroke rasterizer against pydiffvg')
+    parser.add_argument("-st", "--strokes", type=int, help="number of strokes", default=1024, dest='strokes')
+    parser.add_argument("-s",  "--size", nargs=2, type=int, help="canvas size (width height)", default=[400, 224], dest='size')
+    parser.add_argument("-b",  "--batch", type=int, help="canvases per render", default=1, dest='batch')
+    parser.add_argument("-i",  "--iterations", type=int, help="timed iterations", default=10, dest='iterations')
+    parser.add_argument("-ts", "--tile_size", type=int, help="tile size in pixels", default=16, dest='tile_size')
+    parser.add_argument("-dev", "--device", type=str, help="cpu or cuda", default='cuda' if torch.cuda.is_available() else 'cpu', dest='device')
+    benchmark(parser.parse_args())
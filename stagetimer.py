@@ -0,0 +1,115 @@
+# Wall clock timers for the stages of a run (model loading, synth,
+# cutouts, encoders, backward, ...) with an optional per iteration
+# JSONL trace, an end of run summary and a torch profiler window.
+#
+# When timing is off every stage is a bare yield, so the hot path
+# pays nothing. When it is on, cuda is synchronized around each stage
+# so the time lands on the stage that queued the work. A stage run
+# inside another one is recorded as "outer > inner" and left out of the
+# totals, its time already counts towards the outer stage.
+
+import json
+import time
+from contextlib import contextmanager
+
+import torch
+
+class StageTimer:
+    def __init__(self, enabled=False, trace_file=None):
+        self.enabled = enabled or trace_file is not None
+        self.trace = open(trace_file, 'w') if trace_file is not None else None
+        self.sync = torch.cuda.is_available()
+        self.totals = {}
+        self.counts = {}
+        self.current = {}
+        self.stack = []
+        self.profiler = None
+        self.profile_window = None
+        self.profile_output = None
+
+    def set_profile(self, start_iteration, num_iterations, output_file):
+        # capture a full torch profiler trace for a window of iterations
+        self.enabled = True
+        self.profile_window = (start_iteration, start_iteration + num_iterations - 1)
+        self.profile_output = output_file
+
+    def _sync(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._sync()
+        self.stack.append(name)
+        name = ' > '.join(self.stack)
+        start = time.perf_counter()
+        try:
+            # also labels the stage in the profiler trace
+            with torch.autograd.profiler.record_function(name):
+                yield
+        finally:
+            self._sync()
+            self.stack.pop()
+            elapsed = time.perf_counter() - start
+            self.current[name] = self.current.get(name, 0) + elapsed
+            self.totals[name] = self.totals.get(name, 0) + elapsed
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def begin_iteration(self, iteration):
+        # an out of memory retry begins the same iteration again
+        if self.profile_window is not None and iteration == self.profile_window[0] and self.profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.profiler.start()
+
+    def end_iteration(self, iteration):
+        if not self.enabled:
+            return
+        if self.trace is not None and len(self.current) > 0:
+            stages = {name: round(elapsed * 1000, 3) for name, elapsed in self.current.items()}
+            self.trace.write(json.dumps({'iter': iteration, 'ms': stages}) + '\n')
+            self.trace.flush()
+        self.current = {}
+        if self.profiler is not None and iteration == self.profile_window[1]:
+            self.stop_profile()
+
+    def stop_profile(self):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        self.profiler.export_chrome_trace(self.profile_output)
+        sort_by = 'cuda_time_total' if torch.cuda.is_available() else 'cpu_time_total'
+        print(self.profiler.key_averages().table(sort_by=sort_by, row_limit=20))
+        print(f"Wrote profiler trace {self.profile_output}")
+        self.profiler = None
+
+    def summary(self):
+        # only top level stages add up to the total, nested ones are
+        # listed under their outer stage
+        top_level = [name for name in self.totals if ' > ' not in name]
+        total = sum(self.totals[name] for name in top_level)
+        lines = [f"{'stage':<28}{'calls':>8}{'total s':>10}{'mean ms':>10}{'%':>7}"]
+        for name in sorted(top_level, key=lambda name: -self.totals[name]):
+            nested = sorted([n for n in self.totals if n.startswith(name + ' > ')], key=lambda n: -self.totals[n])
+            for row in [name] + nested:
+                elapsed = self.totals[row]
+                count = self.counts[row]
+                label = row if row == name else '  ' + row[len(name) + 3:]
+                lines.append(f"{label:<28}{count:>8}{elapsed:>10.2f}{elapsed * 1000 / count:>10.2f}"
+                             f"{100 * elapsed / max(total, 1e-9):>7.1f}")
+        lines.append(f"{'total':<28}{'':>8}{total:>10.2f}")
+        return '\n'.join(lines)
+
+    def close(self):
+        # stops a profiler window cut short by the end of the run
+        self.stop_profile()
+        if self.enabled and len(self.totals) > 0:
+            print(self.summary())
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
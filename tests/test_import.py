@@ -0,0 +1,25 @@
+# importing clipit must not load the drawers or the heavy optional
+# dependencies, they are imported where a run actually uses them
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+deferred_modules = ['vqgan', 'clipdrawer', 'pixeldrawer', 'CLIP', 'torch_optimizer', 'imageio']
+
+def test_import_defers_heavy_modules():
+    # clipit itself needs these at import time
+    for module in ['torch', 'torchvision', 'kornia']:
+        pytest.importorskip(module)
+    code = (
+        "import sys, clipit\n"
+        f"print(','.join(m for m in {deferred_modules!r} if m in sys.modules))\n"
+    )
+    result = subprocess.run([sys.executable, '-c', code], cwd=repo_dir,
+                            capture_output=True, text=True, check=True)
+    loaded = result.stdout.strip().splitlines()[-1] if result.stdout.strip() else ''
+    assert loaded == '', f"loaded at import: {loaded}"
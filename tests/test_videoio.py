@@ -0,0 +1,50 @@
+# round trip of a tiny synthetic clip through the ffmpeg pipes used by
+# the style video mode
+
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None,
+                                reason="ffmpeg not installed")
+
+def make_clip(path, num_frames=6, size=(64, 48), fps=6):
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi',
+           '-i', f'testsrc=size={size[0]}x{size[1]}:rate={fps}',
+           '-frames:v', str(num_frames), '-pix_fmt', 'yuv420p', path]
+    subprocess.run(cmd, check=True)
+
+def test_read_write_round_trip(tmp_path):
+    pytest.importorskip('PIL')
+    from videoio import VideoReader, VideoWriter
+
+    clip = str(tmp_path / 'clip.mp4')
+    make_clip(clip)
+    reader = VideoReader(clip, 32, 24)
+    assert reader.fps == pytest.approx(6)
+    frames = list(reader)
+    assert len(frames) == 6
+    assert all(frame.size == (32, 24) for frame in frames)
+
+    output = str(tmp_path / 'out.mp4')
+    writer = VideoWriter(output, 32, 24, fps=6)
+    for frame in frames:
+        writer.write(frame)
+    assert writer.close() == output
+
+    frames = list(VideoReader(output, 32, 24))
+    assert len(frames) == 6
+    assert all(frame.size == (32, 24) for frame in frames)
+
+def test_missing_input_raises(tmp_path):
+    pytest.importorskip('PIL')
+    from videoio import VideoReader
+
+    with pytest.raises(RuntimeError):
+        list(VideoReader(str(tmp_path / 'missing.mp4'), 32, 24))
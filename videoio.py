@@ -0,0 +1,77 @@
+# Streaming video input and output through ffmpeg pipes.
+# Frames go through as raw rgb so nothing touches the disk except the
+# source and the final encoded video.
+
+import subprocess
+
+from PIL import Image
+
+def probe_fps(input_file):
+    # frame rate of the first video stream, None if ffprobe can't tell
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'stream=r_frame_rate', '-of', 'csv=p=0', input_file]
+    try:
+        rate = subprocess.check_output(cmd).decode().strip()
+        num, _, den = rate.partition('/')
+        return float(num) / float(den or 1)
+    except (OSError, subprocess.CalledProcessError, ValueError, ZeroDivisionError):
+        return None
+
+class VideoReader:
+    # iterates over the frames of a video as PIL images of width x height
+    def __init__(self, input_file, width, height):
+        self.input_file = input_file
+        self.width = width
+        self.height = height
+        self.fps = probe_fps(input_file)
+        cmd = ['ffmpeg', '-loglevel', 'error', '-i', input_file,
+               '-vf', f'scale={width}:{height}',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-']
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+    def __iter__(self):
+        # a missing or unreadable input raises instead of looking like
+        # an empty video
+        frame_size = self.width * self.height * 3
+        num_frames = 0
+        while True:
+            data = self.proc.stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            num_frames += 1
+            yield Image.frombytes('RGB', (self.width, self.height), data)
+        self.proc.stdout.close()
+        if self.proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg could not read {self.input_file} (exit status {self.proc.returncode})")
+        if num_frames == 0:
+            raise RuntimeError(f"No frames read from {self.input_file}")
+
+class VideoWriter:
+    def __init__(self, output_file, width, height, fps=30, comment=None, crf=17):
+        self.width = width
+        self.height = height
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+               '-s', f'{width}x{height}', '-r', str(fps),
+               '-i', '-',
+               # yuv420p needs even dimensions
+               '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+               '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', '-crf', str(crf)]
+        if comment is not None:
+            cmd += ['-metadata', f'comment={comment}']
+        cmd.append(output_file)
+        self.output_file = output_file
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, img):
+        # img is a PIL image, resized if needed to the video size
+        img = img.convert('RGB')
+        if img.size != (self.width, self.height):
+            img = img.resize((self.width, self.height), Image.LANCZOS)
+        self.proc.stdin.write(img.tobytes())
+
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg could not write {self.output_file} (exit status {self.proc.returncode})")
+        return self.output_file
@@ -1,7 +1,7 @@
 # Originally made by Katherine Crowson (https://github.com/crowsonkb, https://twitter.com/RiversHaveWings)
 # The original BigGAN+CLIP method was by https://twitter.com/advadnoun
 
-from DrawingInterface import DrawingInterface
+from DrawingInterface import DrawingInterface, migrate_optimizer_state
 
 import sys
 import subprocess
@@ -150,6 +150,9 @@ class VqganDrawer(DrawingInterface):
     def reapply_from_tensor(self, new_tensor):
         new_z, *_ = self.model.encode(new_tensor)        
         with torch.no_grad():
+            if new_z.shape != self.z.shape:
+                # optimizing at a coarser stage of a resolution schedule
+                new_z = F.interpolate(new_z, size=self.z.shape[-2:], mode='bilinear', align_corners=False)
             self.z.copy_(new_z)
 
     def get_z_from_tensor(self, ref_tensor):
@@ -159,11 +162,34 @@ class VqganDrawer(DrawingInterface):
     def get_num_resolutions(self):
         return self.model.decoder.num_resolutions
 
+    def replace_z(self, new_z, opts=None, remap=None):
+        # swap in a new z tensor (eg: a different shape), moving any
+        # optimizer state over with remap
+        old_z = self.z
+        self.z = new_z.detach().clone().requires_grad_(True)
+        migrate_optimizer_state(opts, old_z, self.z, remap)
+
+    def resize_z(self, toksX, toksY, opts=None):
+        # upsample (or downsample) the latent grid for a resolution schedule
+        def remap(t):
+            return F.interpolate(t, size=(toksY, toksX), mode='bilinear', align_corners=False)
+        with torch.no_grad():
+            new_z = remap(self.z)
+        self.replace_z(new_z, opts, remap)
+
     def synth(self, cur_iteration):
+        return self.decode_z(self.z)
+
+    def quantize_z(self, z):
         if self.gumbel:
-            z_q = vector_quantize(self.z.movedim(1, 3), self.model.quantize.embed.weight).movedim(3, 1)       # Vector quantize
+            return vector_quantize(z.movedim(1, 3), self.model.quantize.embed.weight).movedim(3, 1)       # Vector quantize
         else:
-            z_q = vector_quantize(self.z.movedim(1, 3), self.model.quantize.embedding.weight).movedim(3, 1)
+            return vector_quantize(z.movedim(1, 3), self.model.quantize.embedding.weight).movedim(3, 1)
+
+    def decode_z(self, z, quantize=True):
+        # quantize=False decodes an already quantized z as is (eg: a blend
+        # of two quantized keyframes, which would otherwise snap per token)
+        z_q = self.quantize_z(z) if quantize else z
         return clamp_with_grad(self.model.decode(z_q).add(1).div(2), 0, 1)
 
     @torch.no_grad()
@@ -171,10 +197,28 @@ class VqganDrawer(DrawingInterface):
         out = self.synth(None)
         return TF.to_pil_image(out[0].cpu())
 
+    @torch.no_grad()
+    def to_images(self):
+        # one image per entry when z holds a batch (eg: animation frames)
+        out = self.synth(None)
+        return [TF.to_pil_image(frame.cpu()) for frame in out]
+
     def clip_z(self):
         with torch.no_grad():
             self.z.copy_(self.z.maximum(self.z_min).minimum(self.z_max))
 
+    def get_state(self):
+        # everything needed to continue a run (see clipit checkpoints)
+        return {'z': self.z.detach().cpu()}
+
+    def set_state(self, state, opts=None):
+        new_z = state['z'].to(self.z.device)
+        if new_z.shape != self.z.shape:
+            # eg: saved at another resolution stage or as animation frames
+            self.replace_z(new_z, opts)
+        else:
+            self.set_z(new_z)
+
     def get_z(self):
         return self.z
 